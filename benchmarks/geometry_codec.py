@@ -0,0 +1,82 @@
+"""
+This script measures the cost of parsing one geojson geometry
+into a GEOSGeometry and writing it as WKT, with the Shapely WKT
+round trip used before and with the geojson_rest.geometry codec.
+
+usage: python benchmarks/geometry_codec.py [repeat]
+
+The Shapely measurements are skipped if Shapely is not installed.
+"""
+import math
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from django.conf import settings
+if not settings.configured:
+    settings.configure()
+
+from django.contrib.gis.geos import GEOSGeometry
+from geojson_rest.geometry import from_geojson
+from geojson_rest.geometry import to_wkt
+
+try:
+    from shapely.geometry import asShape
+except ImportError:
+    asShape = None
+
+def circle(vertices):
+    ring = [[20 + math.cos(2 * math.pi * i / vertices),
+             30 + math.sin(2 * math.pi * i / vertices)]
+            for i in range(vertices)]
+    return ring + ring[:1]
+
+GEOMETRIES = [
+    ('point', {'type': 'Point',
+               'coordinates': [20, 30]}),
+    ('line 100', {'type': 'LineString',
+                  'coordinates': circle(100)[:100]}),
+    ('polygon 10000', {'type': 'Polygon',
+                       'coordinates': [circle(10000)]}),
+]
+
+def shapely_parse(geometry):
+    return GEOSGeometry(asShape(geometry).to_wkt(), 4326)
+
+def shapely_wkt(geometry):
+    return asShape(geometry).to_wkt()
+
+def codec_parse(geometry):
+    return from_geojson(geometry, 4326)
+
+def per_call(func, geometry, repeat):
+    """
+    This function returns the best time of one call in
+    microseconds.
+    """
+    number = max(1, repeat / max(1, len(str(geometry)) / 1000))
+    best = min(timeit.repeat(lambda: func(geometry), repeat = 3, number = number))
+    return best / number * 1e6
+
+def main():
+    repeat = 10000
+    if len(sys.argv) > 1:
+        repeat = int(sys.argv[1])
+
+    print '%-16s %-8s %14s %14s' % ('geometry', 'step', 'shapely (us)', 'codec (us)')
+    for name, geometry in GEOMETRIES:
+        for step, before, after in (('parse', shapely_parse, codec_parse),
+                                    ('wkt', shapely_wkt, to_wkt)):
+            if asShape is not None:
+                before_time = '%14.1f' % per_call(before, geometry, repeat)
+            else:
+                before_time = '%14s' % '-'
+            print '%-16s %-8s %s %14.1f' % (name,
+                                            step,
+                                            before_time,
+                                            per_call(after, geometry, repeat))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+This script measures encoding and decoding a feature collection
+of 10000 features with each installed json backend of
+geojson_rest.jsonbackend.
+
+usage: python benchmarks/json_backend.py [features]
+"""
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from django.conf import settings
+if not settings.configured:
+    settings.configure()
+
+from geojson_rest.jsonbackend import AUTO_BACKENDS
+from geojson_rest.jsonbackend import load_backend
+
+def feature_collection(count):
+    random.seed(0)
+    features = []
+    for i in xrange(count):
+        features.append({
+            'type': 'Feature',
+            'id': i,
+            'private': False,
+            'geometry': {'type': 'Point',
+                         'coordinates': [random.uniform(19, 32),
+                                         random.uniform(59, 70)]},
+            'properties': {'id': i,
+                           'user': 'user%i' % (i % 100),
+                           'group': 'survey',
+                           'time': {'create_time': '2013-05-02T12:00:00+00:00',
+                                    'expire_time': ''},
+                           'answer': u'vastaus %i \xe4\xf6' % i,
+                           'rating': i % 5,
+                           'visited': i % 2 == 0},
+            'time': {'create_time': '2013-05-02T12:00:00+00:00',
+                     'expire_time': ''},
+            'user': 'user%i' % (i % 100),
+            'group': 'survey'
+        })
+    return {'type': 'FeatureCollection',
+            'features': features,
+            'crs': {'type': 'name', 'properties': {'code': 'EPSG:4326'}}}
+
+def main():
+    count = 10000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    collection = feature_collection(count)
+    print '%i features' % count
+    print '%-12s %12s %12s %12s' % ('backend', 'dumps (ms)', 'loads (ms)', 'size (kB)')
+    for name in AUTO_BACKENDS:
+        try:
+            backend = load_backend(name)
+        except ImportError:
+            print '%-12s %12s' % (name, 'not installed')
+            continue
+        json_str = backend.dumps(collection)
+        dumps_time = min(timeit.repeat(lambda: backend.dumps(collection),
+                                       repeat = 5,
+                                       number = 1))
+        loads_time = min(timeit.repeat(lambda: backend.loads(json_str),
+                                       repeat = 5,
+                                       number = 1))
+        print '%-12s %12.1f %12.1f %12.1f' % (name,
+                                              dumps_time * 1000,
+                                              loads_time * 1000,
+                                              len(json_str) / 1024.0)
+
+if __name__ == '__main__':
+    main()
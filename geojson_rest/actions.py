@@ -2,14 +2,15 @@
 This file contains admin actions used by the geojson_rest application
 """
 import csv
-import json
 import types
-from django.contrib.gis.geos import GEOSGeometry
-from django.http import HttpResponse
+from StringIO import StringIO
+from django.http import StreamingHttpResponse
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
-
-from shapely.geometry import asShape
+from geojson_rest import jsonbackend as json
+from geojson_rest.geometry import to_wkt
+from geojson_rest.models import Feature
+from geojson_rest.utils import json_seq_chunks
 
 def download_csv(modeladmin, request, queryset):
     """
@@ -18,65 +19,46 @@ def download_csv(modeladmin, request, queryset):
     to have their own .to_json() function which will provide
     the json representation of that object.
 
+    The csv is streamed while it is written. The objects are
+    read GEOJSON_REST_CHUNK_SIZE at a time in id order, so only
+    one chunk is kept in memory. Models with a schema registry
+    give the header with get_schema_selectors, for other models
+    the objects are read twice, first to collect the header.
+
     Special reserved values include
     geometry - should represent a geojson geometry otherwise skipped
     """
     srid = None
-    if len(queryset) > 0 and hasattr(queryset[0], 'geometry'):
-        srid = queryset[0].geometry.srid
+    first_objects = list(queryset[:1])
+    if len(first_objects) > 0 and hasattr(first_objects[0], 'geometry'):
+        srid = first_objects[0].geometry.srid
 #    else:
 #        srid = getattr(settings, "SPATIAL_REFERENCE_SYSTEM_ID", 4326)
 
     #make the response object to write to
-    response = HttpResponse(mimetype='text/csv')
+    response = StreamingHttpResponse(csv_rows(queryset),
+                                     content_type = 'text/csv')
     if srid is not None:
         response['Content-Disposition'] = 'attachment; filename={0}_{1}.csv'.format(modeladmin, srid)
     else:
         response['Content-Disposition'] = 'attachment; filename={0}.csv'.format(modeladmin)
 
-    #create a csv writer
-    writer = csv.writer(response)
-
-    #create a json list of the queryset objects
-    dict_list = [obj.to_json() for obj in queryset]
-
-    #selector list is the header of the csv file
-    selector_list = get_selectors(dict_list)
-    # change column name 'geometry' to 'wkt' in csv header
-    csv_header = ['wkt' if x == 'geometry' else x for x in selector_list]
-    writer.writerow(csv_header)
-
-    for dict_json in dict_list:
+    return response
 
-        value = dict_json
-        values = []
-        for selector in selector_list:
-
-            #handle the geometry geojson and present it as WKT
-            if selector == 'geometry':
-#                value = GEOSGeometry(json.dumps(value[selector])).wkt
-                # All geometry from/to_json functions in GeoDjango use
-                # gdal and from_json has some problems. We use Shapely instead.
-                value = asShape(value[selector]).to_wkt()
-            else:
-                split_selector = selector.split('.')
-                #print("selector:" + selector)
-                for part_selector in split_selector:
-                    try:
-                        value = value[unicode(part_selector, 'utf-8')]
-                    except KeyError:
-                        value = u''
-                        break
-
-            values.append(unicode(value).encode('utf-8'))
-            value = dict_json
-
-        writer.writerow(values)
-        values = []
+download_csv.short_description = _(u'Download as a csv file')
 
+def download_geojsonseq(modeladmin, request, queryset):
+    """
+    This action streams the selected features as a GeoJSON
+    text sequence (RFC 8142), one feature per line, written
+    from the cached json of the features.
+    """
+    response = StreamingHttpResponse(json_seq_chunks(Feature.json_str_chunks(queryset)),
+                                     content_type = 'application/geo+json-seq')
+    response['Content-Disposition'] = 'attachment; filename={0}.geojsons'.format(modeladmin)
     return response
 
-download_csv.short_description = _(u'Download as a csv file')
+download_geojsonseq.short_description = _(u'Download as a geojson text sequence')
 
 def get_selectors(json_list):
     """
@@ -87,6 +69,7 @@ def get_selectors(json_list):
     geometry - should represent a geojson geometry otherwise skipped
     """
     key_selectors = []
+    seen = set()
 
     for obj in json_list:
         keys = obj.keys()
@@ -104,10 +87,115 @@ def get_selectors(json_list):
                     else:
                         subkey_selector = unicode(subkey_selector).encode('utf-8')
 
-                    if subkey_selector not in key_selectors:
+                    if subkey_selector not in seen:
+                        seen.add(subkey_selector)
                         key_selectors.append(subkey_selector)
 
-            elif key_selector not in key_selectors:
+            elif key_selector not in seen:
+                seen.add(key_selector)
                 key_selectors.append(key_selector)
 
-    return key_selectors
\ No newline at end of file
+    return key_selectors
+
+def json_chunks(queryset, chunk_size = None):
+    """
+    This function yields the json of the queryset objects as
+    lists of chunk_size dictionaries in id order.
+
+    Models with cached json, like Feature, are read from the
+    cache with a few queries for each chunk, the related rows
+    of other models are joined to the objects.
+    """
+    if chunk_size is None:
+        chunk_size = getattr(settings, 'GEOJSON_REST_CHUNK_SIZE', 1000)
+
+    if hasattr(queryset.model, 'json_str_chunks'):
+        for json_strs in queryset.model.json_str_chunks(queryset,
+                                                        chunk_size = chunk_size):
+            yield [json.loads(json_str) for json_str in json_strs]
+        return
+
+    queryset = queryset.select_related().order_by('pk')
+    last_pk = None
+    while True:
+        chunk = queryset
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt = last_pk)
+        objs = list(chunk[:chunk_size])
+        yield [obj.to_json() for obj in objs]
+
+        if len(objs) < chunk_size:
+            break
+        last_pk = objs[-1].pk
+
+def csv_rows(queryset, progress = None):
+    """
+    This function yields the csv text of the queryset objects,
+    the header first and then the rows of one chunk at a time.
+    The header is sent before any object is read if the model
+    has a schema registry.
+
+    progress -- function called with the number of rows of
+                each chunk after they are written
+    """
+    #selector list is the header of the csv file
+    if hasattr(queryset.model, 'get_schema_selectors'):
+        selector_list = queryset.model.get_schema_selectors(queryset)
+    else:
+        #collected in the same order as get_selectors would for the whole list
+        selector_list = []
+        seen = set()
+        for dict_list in json_chunks(queryset):
+            for selector in get_selectors(dict_list):
+                if selector not in seen:
+                    seen.add(selector)
+                    selector_list.append(selector)
+
+    #create a csv writer
+    buf = StringIO()
+    writer = csv.writer(buf)
+
+    # change column name 'geometry' to 'wkt' in csv header
+    csv_header = ['wkt' if x == 'geometry' else x for x in selector_list]
+    writer.writerow(csv_header)
+    yield buf.getvalue()
+    buf.seek(0)
+    buf.truncate()
+
+    for dict_list in json_chunks(queryset):
+        for dict_json in dict_list:
+            writer.writerow(csv_values(dict_json, selector_list))
+        if progress is not None:
+            progress(len(dict_list))
+
+        if buf.tell() > 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+
+def csv_values(dict_json, selector_list):
+    """
+    This function returns the values of the selectors in the
+    json of one object as utf-8 encoded strings.
+    """
+    value = dict_json
+    values = []
+    for selector in selector_list:
+
+        #handle the geometry geojson and present it as WKT
+        if selector == 'geometry':
+            value = to_wkt(value[selector])
+        else:
+            split_selector = selector.split('.')
+            for part_selector in split_selector:
+                try:
+                    value = value[unicode(part_selector, 'utf-8')]
+                except (KeyError, TypeError):
+                    #the key is missing or the value is not an object
+                    value = u''
+                    break
+
+        values.append(unicode(value).encode('utf-8'))
+        value = dict_json
+
+    return values
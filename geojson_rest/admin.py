@@ -1,5 +1,14 @@
 from geojson_rest.actions import download_csv
+from geojson_rest.actions import download_geojsonseq
+import os
 from django.conf import settings
+from django.conf.urls import patterns
+from django.conf.urls import url
+from django.core.servers.basehttp import FileWrapper
+from django.core.urlresolvers import reverse
+from django.http import Http404
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
 from django.core.urlresolvers import reverse_lazy
 from django.contrib import admin
 from django.contrib.gis import admin as gisadmin
@@ -7,8 +16,10 @@ from django.utils.translation import ugettext_lazy as _
 # from geojson_rest.models import PointFeature
 # from geojson_rest.models import LinestringFeature
 # from geojson_rest.models import PolygonFeature
+from geojson_rest.models import ExportJob
 from geojson_rest.models import Feature
 from geojson_rest.models import Property
+from geojson_rest.models import PropertySchemaKey
 
 class HasFeatureFilter(admin.SimpleListFilter):
     # Human-readable title which will be displayed in the
@@ -57,9 +68,8 @@ class FeatureAdmin(gisadmin.OSMGeoAdmin):
     list_filter = ('group', 'private',)
     openlayers_url = '%s%s' % (getattr(settings, 'STATIC_URL', '/'),
                                'js/libs/OpenLayers.js')
-    actions = [download_csv]
     modifiable = False
-    actions = ['delete_selected']
+    actions = ['delete_selected', download_csv, download_geojsonseq]
     
 
     def delete_selected(self, request, queryset):
@@ -94,3 +104,104 @@ class PropertyAdmin(admin.ModelAdmin):
 
 admin.site.register(Property, PropertyAdmin)
 
+
+class PropertySchemaKeyAdmin(admin.ModelAdmin):
+    search_fields = ('group', 'key')
+    list_display = ('group',
+                    'key',
+                    'value_type')
+    list_filter = ('group', 'value_type',)
+    readonly_fields = ('group',
+                       'key',
+                       'value_type')
+
+    def __str__(self):
+        return "PropertySchemaKey"
+
+
+admin.site.register(PropertySchemaKey, PropertySchemaKeyAdmin)
+
+
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = ('group',
+                    'format',
+                    'status',
+                    'get_progress',
+                    'rows',
+                    'created',
+                    'finished',
+                    'get_download_link')
+    list_filter = ('status', 'format',)
+    search_fields = ('group',)
+    readonly_fields = ('user',
+                       'status',
+                       'worker',
+                       'rows',
+                       'total_rows',
+                       'file_path',
+                       'error',
+                       'started',
+                       'updated',
+                       'finished')
+    actions = ['requeue']
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            obj.user = request.user
+        obj.save()
+
+    def get_urls(self):
+        urls = patterns('',
+            url(r'^(\d+)/download/$',
+                self.admin_site.admin_view(self.download),
+                name = 'geojson_rest_exportjob_download'),
+        )
+        return urls + super(ExportJobAdmin, self).get_urls()
+
+    def download(self, request, job_id):
+        """
+        This view returns the compressed file of a finished
+        export job.
+        """
+        job = get_object_or_404(ExportJob, id = job_id)
+        if job.status != 'done' or not os.path.exists(job.file_path):
+            raise Http404('The export is not ready')
+
+        response = StreamingHttpResponse(FileWrapper(open(job.file_path, 'rb')),
+                                         content_type = 'application/gzip')
+        response['Content-Length'] = os.path.getsize(job.file_path)
+        response['Content-Disposition'] = 'attachment; filename={0}'.format(
+                os.path.basename(job.file_path))
+        return response
+
+    def get_download_link(self, obj):
+        if obj.status != 'done':
+            return u''
+        return u'<a href="%s">%s</a>' % (reverse('admin:geojson_rest_exportjob_download',
+                                                 args = (obj.id,)),
+                                         _('download'))
+    get_download_link.short_description = _('file')
+    get_download_link.allow_tags = True
+
+    def requeue(self, request, queryset):
+        """
+        This action returns failed or interrupted jobs to
+        the queue of the workers, the other jobs are left as
+        they are.
+        """
+        queryset = queryset.filter(id__in = ExportJob.get_requeueable().values('id'))
+        count = queryset.update(status = 'pending',
+                                worker = '',
+                                rows = 0,
+                                error = '',
+                                started = None,
+                                updated = None,
+                                finished = None)
+        self.message_user(request, _("%i failed or stalled exports will be run again.") % count)
+    requeue.short_description = _('run the selected exports again')
+
+    def __str__(self):
+        return "ExportJob"
+
+
+admin.site.register(ExportJob, ExportJobAdmin)
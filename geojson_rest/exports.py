@@ -0,0 +1,103 @@
+"""
+This file contains the background exports of the features
+of a group, see ExportJob and the run_export_jobs command.
+
+The exports are written gzip compressed to the directory
+GEOJSON_REST_EXPORT_ROOT, by default geojson_exports in the
+MEDIA_ROOT. Each file is written under a temporary name and
+renamed when it is complete.
+"""
+import gzip
+import os
+import traceback
+from django.conf import settings
+from geojson_rest.actions import csv_rows
+from geojson_rest.models import Feature
+from geojson_rest.utils import feature_collection_chunks
+from geojson_rest.utils import json_seq_chunks
+
+# the file extensions of the export formats
+EXTENSIONS = {
+    'csv': 'csv',
+    'geojson': 'geojson',
+    'geojsonseq': 'geojsons',
+}
+
+def get_export_root():
+    return getattr(settings,
+                   'GEOJSON_REST_EXPORT_ROOT',
+                   os.path.join(settings.MEDIA_ROOT, 'geojson_exports'))
+
+def get_export_path(job):
+    """
+    This function returns the path of the file of the job,
+    the name is made of the job id only because the group is
+    free text.
+    """
+    return os.path.join(get_export_root(),
+                        'export_%i.%s.gz' % (job.id,
+                                             EXTENSIONS[job.format]))
+
+def counted_chunks(json_str_chunks, progress):
+    """
+    This function yields the chunks and calls progress with
+    the number of json strings in each chunk after it is used.
+    """
+    for json_strs in json_str_chunks:
+        yield json_strs
+        progress(len(json_strs))
+
+def export_chunks(job, features):
+    """
+    This function returns the text chunks of the export of
+    the features in the format of the job.
+    """
+    if job.format == 'csv':
+        return csv_rows(features, job.add_rows)
+
+    json_str_chunks = counted_chunks(Feature.json_str_chunks(features),
+                                     job.add_rows)
+    if job.format == 'geojsonseq':
+        return json_seq_chunks(json_str_chunks)
+
+    srid = Feature._meta.get_field('geometry').srid
+    featurecollection = {
+        'type': 'FeatureCollection',
+        'features': 'FEATURES',
+        'crs': {"type": "name", "properties": {"code": "EPSG:%i" % srid}}
+    }
+    return feature_collection_chunks(featurecollection, json_str_chunks)
+
+def run_job(job):
+    """
+    This function writes the export of a claimed job and
+    records the result in the job.
+
+    returns True if the export was written
+    """
+    features = Feature.objects.filter(group = job.group)
+    path = get_export_path(job)
+    temp_path = '%s.tmp' % path
+    try:
+        job.total_rows = features.count()
+        job.save(update_fields = ['total_rows'])
+
+        if not os.path.isdir(get_export_root()):
+            os.makedirs(get_export_root())
+        export_file = gzip.open(temp_path, 'wb')
+        try:
+            for chunk in export_chunks(job, features):
+                if isinstance(chunk, unicode):
+                    chunk = chunk.encode('utf-8')
+                export_file.write(chunk)
+        finally:
+            export_file.close()
+        os.rename(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        job.finish('failed', error = traceback.format_exc())
+        return False
+
+    job.finish('done', file_path = path)
+    return True
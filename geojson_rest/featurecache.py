@@ -0,0 +1,106 @@
+"""
+This file contains the optional cache of serialized feature
+collections shared by the application servers.
+
+The cache is used when GEOJSON_REST_CACHE_ENABLED is True.
+GEOJSON_REST_CACHE names the cache of the CACHES setting to use,
+by default a local memory cache of each process is used. The
+keys contain the version of the group, so every write to a group
+makes its cached collections unreachable and they expire after
+GEOJSON_REST_CACHE_TIMEOUT seconds.
+"""
+import time
+from django.conf import settings
+from django.core.cache import get_cache
+
+LOCMEM_BACKEND = 'django.core.cache.backends.locmem.LocMemCache'
+
+# the counters reported by get_stats
+STATS = ('hits', 'misses', 'waits')
+
+# the counters are kept for 30 days, the longest relative memcached timeout
+STATS_TIMEOUT = 30 * 24 * 60 * 60
+
+_caches = {}
+
+def is_enabled():
+    return getattr(settings, 'GEOJSON_REST_CACHE_ENABLED', False)
+
+def get_feature_cache():
+    """
+    This function returns the configured cache, the backend
+    is created only once for each setting value.
+    """
+    name = getattr(settings, 'GEOJSON_REST_CACHE', LOCMEM_BACKEND)
+    if name not in _caches:
+        _caches[name] = get_cache(name)
+    return _caches[name]
+
+def get_or_build(key, build):
+    """
+    This function returns the cached value of the key or builds
+    it with build() and caches it.
+
+    Only one worker builds a missing key at a time, the others
+    wait up to GEOJSON_REST_CACHE_LOCK_TIMEOUT seconds for the value
+    and build it without caching if it does not appear.
+
+    returns a tuple of the value and 'hit' or 'miss'
+    """
+    cache = get_feature_cache()
+    value = cache.get(key)
+    if value is not None:
+        count('hits')
+        return (value, 'hit')
+
+    lock_timeout = getattr(settings, 'GEOJSON_REST_CACHE_LOCK_TIMEOUT', 30)
+    lock_key = '%s:lock' % key
+    if cache.add(lock_key, 1, lock_timeout):
+        count('misses')
+        try:
+            value = build()
+            cache.set(key,
+                      value,
+                      getattr(settings, 'GEOJSON_REST_CACHE_TIMEOUT', 300))
+        finally:
+            cache.delete(lock_key)
+        return (value, 'miss')
+
+    # another worker is building the value, a waiter is counted
+    # as a hit if the value appears and as a miss if it builds it
+    count('waits')
+    deadline = time.time() + lock_timeout
+    while time.time() < deadline:
+        time.sleep(0.05)
+        value = cache.get(key)
+        if value is not None:
+            count('hits')
+            return (value, 'hit')
+        if cache.get(lock_key) is None:
+            break
+    count('misses')
+    return (build(), 'miss')
+
+def count(name):
+    cache = get_feature_cache()
+    key = 'geojson_rest:stats:%s' % name
+    # add is a no-op if the counter exists, incr fails if it expired meanwhile
+    cache.add(key, 0, STATS_TIMEOUT)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, STATS_TIMEOUT)
+
+def get_stats():
+    """
+    This function returns the hit, miss and wait counters of
+    the cache as a dictionary.
+    """
+    keys = ['geojson_rest:stats:%s' % name for name in STATS]
+    values = get_feature_cache().get_many(keys)
+    return dict([(name, values.get(key, 0))
+                 for name, key in zip(STATS, keys)])
+
+def reset_stats():
+    get_feature_cache().delete_many(['geojson_rest:stats:%s' % name
+                                     for name in STATS])
@@ -0,0 +1,278 @@
+"""
+This file contains the conversions between geojson geometries
+and GEOS geometries used by the geojson_rest application.
+
+The geojson coordinates are packed directly into WKB which
+GEOS parses in one call, so no intermediate geometry library
+or WKT round trip is needed.
+"""
+import struct
+from django.contrib.gis.geos import GEOSException
+from django.contrib.gis.geos import GEOSGeometry
+
+# WKB geometry type codes
+WKB_TYPES = {
+    'Point': 1,
+    'LineString': 2,
+    'Polygon': 3,
+    'MultiPoint': 4,
+    'MultiLineString': 5,
+    'MultiPolygon': 6,
+    'GeometryCollection': 7,
+}
+
+# the EWKB flag of geometries with z coordinates, understood by all GEOS versions
+WKB_Z_FLAG = 0x80000000
+
+def get_srid(geojson):
+    """
+    This function returns the srid given in the crs of a
+    geojson object, None if the object has no crs.
+
+    crs should be of the form
+    {"type": "name", "properties": {"name": "EPSG:<srid>"}}
+    the name can also be an OGC URN like
+    urn:ogc:def:crs:EPSG::<srid> or urn:ogc:def:crs:OGC:1.3:CRS84,
+    the code member written by the views is read like the name
+
+    raises ValueError if the crs is malformed
+    """
+    if geojson.get('crs') is None:
+        return None
+    try:
+        properties = geojson['crs']['properties']
+        parts = properties.get('name', properties.get('code')).upper().split(':')
+        if parts[-1] == 'CRS84':
+            return 4326
+        elif 'EPSG' not in parts:
+            raise ValueError
+        return int(parts[-1])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        raise ValueError('the crs should be named EPSG:<srid>')
+
+def from_geojson(geometry, srid = None):
+    """
+    This function returns the geojson geometry dictionary
+    as a GEOSGeometry with the given srid.
+
+    raises ValueError if the geometry is not valid geojson
+    """
+    try:
+        return GEOSGeometry(buffer(to_wkb(geometry)), srid)
+    except GEOSException:
+        raise ValueError('the geometry could not be parsed')
+
+def get_dimension(geometry):
+    """
+    This function returns the number of dimensions of the
+    first position of the geometry, 2 or 3.
+    """
+    if geometry['type'] == 'GeometryCollection':
+        for member in geometry['geometries']:
+            return get_dimension(member)
+        return 2
+
+    position = geometry['coordinates']
+    while len(position) > 0 and isinstance(position[0], (list, tuple)):
+        position = position[0]
+    if len(position) > 2:
+        return 3
+    return 2
+
+def to_wkb(geometry, dimension = None):
+    """
+    This function writes a geojson geometry dictionary as
+    little endian WKB.
+
+    raises ValueError if the geometry is not valid geojson
+    """
+    try:
+        geometry_type = geometry['type']
+        wkb_type = WKB_TYPES[geometry_type]
+        if dimension is None:
+            dimension = get_dimension(geometry)
+        if dimension == 3:
+            wkb_type |= WKB_Z_FLAG
+
+        header = struct.pack('<BI', 1, wkb_type)
+        if geometry_type == 'Point':
+            return header + pack_positions([geometry['coordinates']], dimension)
+        elif geometry_type == 'LineString':
+            return header + pack_ring(geometry['coordinates'], dimension)
+        elif geometry_type == 'Polygon':
+            return header + pack_polygon(geometry['coordinates'], dimension)
+        elif geometry_type == 'GeometryCollection':
+            members = geometry['geometries']
+            return header + struct.pack('<I', len(members)) + \
+                   ''.join([to_wkb(member, dimension) for member in members])
+
+        # multi geometries are collections of their single counterparts
+        member_type = geometry_type[len('Multi'):]
+        members = geometry['coordinates']
+        return header + struct.pack('<I', len(members)) + \
+               ''.join([to_wkb({'type': member_type,
+                                'coordinates': coordinates},
+                               dimension)
+                        for coordinates in members])
+    except (KeyError, IndexError, TypeError, struct.error):
+        raise ValueError('the geometry is not a valid geojson geometry')
+
+def pack_positions(positions, dimension):
+    values = []
+    for position in positions:
+        if len(position) < dimension:
+            raise ValueError('the positions of a geometry should have '
+                             'the same number of coordinates')
+        values.extend(position[:dimension])
+    return struct.pack('<%id' % len(values), *values)
+
+def pack_ring(positions, dimension):
+    return struct.pack('<I', len(positions)) + \
+           pack_positions(positions, dimension)
+
+def pack_polygon(rings, dimension):
+    return struct.pack('<I', len(rings)) + \
+           ''.join([pack_ring(ring, dimension) for ring in rings])
+
+def to_wkt(geometry):
+    """
+    This function writes a geojson geometry dictionary as
+    WKT with the coordinates in 16 decimals, e.g.
+    POINT (20.0000000000000000 30.0000000000000000)
+
+    raises ValueError if the geometry is not valid geojson
+    """
+    try:
+        geometry_type = geometry['type']
+        if geometry_type == 'GeometryCollection':
+            text = '(%s)' % ', '.join([to_wkt(member)
+                                       for member in geometry['geometries']])
+        else:
+            text = wkt_coordinates(geometry['coordinates'])
+    except (KeyError, IndexError, TypeError):
+        raise ValueError('the geometry is not a valid geojson geometry')
+
+    if geometry_type not in WKB_TYPES:
+        raise ValueError('the geometry is not a valid geojson geometry')
+    if text in ('', '()'):
+        return '%s EMPTY' % geometry_type.upper()
+    if geometry_type != 'GeometryCollection' and get_dimension(geometry) == 3:
+        return '%s Z %s' % (geometry_type.upper(), text)
+    return '%s %s' % (geometry_type.upper(), text)
+
+def wkt_coordinates(coordinates):
+    """
+    This function writes nested geojson coordinates as the
+    parenthesized coordinate text of WKT.
+    """
+    if len(coordinates) > 0 and not isinstance(coordinates[0], (list, tuple)):
+        # a single position, points are the only geometries
+        # where the position is not inside a list
+        return '(%s)' % ' '.join(['%.16f' % value for value in coordinates[:3]])
+    if len(coordinates) > 0 and not isinstance(coordinates[0][0], (list, tuple)):
+        return '(%s)' % ', '.join([' '.join(['%.16f' % value for value in position[:3]])
+                                   for position in coordinates])
+    return '(%s)' % ', '.join([wkt_coordinates(member) for member in coordinates])
+
+def to_geojson(geometry, precision = None):
+    """
+    This function writes a GEOSGeometry as geojson geometry
+    text directly from its WKB, without building the python
+    lists of the coordinates.
+
+    precision -- number of decimals of the coordinates, all
+                 significant decimals are written if None
+    """
+    # GEOS can not write an empty point as WKB
+    if geometry.geom_type == 'Point' and geometry.empty:
+        return '{"type": "Point", "coordinates": []}'
+    return GeoJSONWriter(geometry.wkb, precision).geometry()
+
+
+class GeoJSONWriter(object):
+    """
+    This class reads WKB or EWKB and writes it as geojson
+    geometry text, numbers are written like json.dumps
+    writes floats.
+    """
+    TYPES = dict([(code, name) for name, code in WKB_TYPES.items()])
+
+    def __init__(self, wkb, precision = None):
+        self.wkb = wkb
+        self.offset = 0
+        self.byte_order = '<'
+        if precision is None:
+            self.number = repr
+        else:
+            self.number = lambda value: repr(round(value, precision))
+
+    def read(self, format, count = 1):
+        format = '%s%i%s' % (self.byte_order, count, format)
+        values = struct.unpack_from(format, self.wkb, self.offset)
+        self.offset += struct.calcsize(format)
+        return values
+
+    def header(self):
+        """
+        This function reads the byte order and type of the
+        next geometry and returns the type and the number of
+        values in each position.
+        """
+        if ord(self.wkb[self.offset]) == 1:
+            self.byte_order = '<'
+        else:
+            self.byte_order = '>'
+        self.offset += 1
+
+        wkb_type = self.read('I')[0]
+        dimension = 2
+        # EWKB flags
+        if wkb_type & 0x80000000:
+            dimension += 1
+        if wkb_type & 0x40000000:
+            dimension += 1
+        if wkb_type & 0x20000000:
+            self.read('I')
+        wkb_type &= 0x0fffffff
+        # ISO WKB types
+        if wkb_type > 1000:
+            dimension = (2, 3, 3, 4)[wkb_type / 1000]
+            wkb_type %= 1000
+        return (wkb_type, dimension)
+
+    def geometry(self):
+        wkb_type, dimension = self.header()
+        if wkb_type == WKB_TYPES['GeometryCollection']:
+            count = self.read('I')[0]
+            return '{"type": "GeometryCollection", "geometries": [%s]}' % \
+                   ', '.join([self.geometry() for i in xrange(count)])
+        return '{"type": "%s", "coordinates": %s}' % (self.TYPES[wkb_type],
+                                                      self.coordinates(wkb_type,
+                                                                       dimension))
+
+    def coordinates(self, wkb_type, dimension):
+        if wkb_type == WKB_TYPES['Point']:
+            return self.position(self.read('d', dimension))
+        elif wkb_type == WKB_TYPES['LineString']:
+            return self.positions(dimension)
+        elif wkb_type == WKB_TYPES['Polygon']:
+            count = self.read('I')[0]
+            return '[%s]' % ', '.join([self.positions(dimension)
+                                       for i in xrange(count)])
+
+        # the members of multi geometries have their own headers
+        count = self.read('I')[0]
+        members = []
+        for i in xrange(count):
+            member_type, member_dimension = self.header()
+            members.append(self.coordinates(member_type, member_dimension))
+        return '[%s]' % ', '.join(members)
+
+    def position(self, values):
+        return '[%s]' % ', '.join([self.number(value) for value in values[:3]])
+
+    def positions(self, dimension):
+        count = self.read('I')[0]
+        values = self.read('d', count * dimension)
+        return '[%s]' % ', '.join([self.position(values[i:i + dimension])
+                                   for i in xrange(0, len(values), dimension)])
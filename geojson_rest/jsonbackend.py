@@ -0,0 +1,142 @@
+"""
+This file contains the json serializer used by the geojson_rest
+application, import it in place of the json module:
+
+    from geojson_rest import jsonbackend as json
+
+The library is chosen with the GEOJSON_REST_JSON_BACKEND
+setting, one of 'ujson', 'simplejson' or 'json'. By default
+the fastest installed library is used in that order, with the
+standard library json as the fallback.
+
+Older ujson versions cannot write floats with more than 15
+significant digits. They are skipped by the automatic choice
+so that no float is rounded, and round floats to 15 digits
+only if ujson is configured explicitly.
+
+ujson always writes compact json without spaces after the ','
+and ':' separators while json and simplejson write a space
+after both. The backends write the same values but not the
+same bytes, so a json string written by one backend should
+not be compared as text to one written by another.
+"""
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+# the libraries tried when no backend is configured, fastest first
+AUTO_BACKENDS = ('ujson', 'simplejson', 'json')
+
+_backends = {}
+
+
+class StandardBackend(object):
+    """
+    This class wraps the json module of the standard library
+    or simplejson, both write the same output.
+    """
+    def __init__(self, module):
+        self.name = module.__name__
+        self.module = module
+
+    def dumps(self, obj):
+        return self.module.dumps(obj)
+
+    def loads(self, json_str):
+        return self.module.loads(json_str)
+
+
+class UltraJSONBackend(object):
+    """
+    This class wraps ujson. The output has no spaces after
+    the separators, with a ujson that writes floats precisely
+    it has the same content as the json module. The keyword
+    arguments are passed only if the installed ujson has them.
+
+    precise -- False if the installed ujson rounds floats
+    """
+    name = 'ujson'
+
+    def __init__(self, module):
+        self.module = module
+        self.dump_options = {}
+        self.load_options = {}
+        try:
+            module.dumps('/', escape_forward_slashes = False)
+            self.dump_options['escape_forward_slashes'] = False
+        except TypeError:
+            pass
+        try:
+            module.loads('0.5', precise_float = True)
+            self.load_options['precise_float'] = True
+        except TypeError:
+            pass
+
+        # recent versions write the shortest exact float by default,
+        # older ones round to double_precision digits, 15 at most
+        value = 0.1 + 0.2
+        self.precise = self.loads(self.dumps(value)) == value
+        if not self.precise:
+            try:
+                module.dumps(0.5, double_precision = 15)
+                self.dump_options['double_precision'] = 15
+            except TypeError:
+                pass
+
+    def dumps(self, obj):
+        return self.module.dumps(obj, **self.dump_options)
+
+    def loads(self, json_str):
+        return self.module.loads(json_str, **self.load_options)
+
+
+def load_backend(name):
+    """
+    This function imports the json library of the given
+    name and returns it wrapped in its backend.
+    """
+    if name == 'ujson':
+        import ujson
+        return UltraJSONBackend(ujson)
+    elif name == 'simplejson':
+        import simplejson
+        return StandardBackend(simplejson)
+    elif name == 'json':
+        import json
+        return StandardBackend(json)
+    raise ImproperlyConfigured('GEOJSON_REST_JSON_BACKEND should be one of %s'
+                               % ', '.join(AUTO_BACKENDS))
+
+def get_backend():
+    """
+    This function returns the configured json backend, the
+    backend is loaded only once for each setting value.
+    """
+    name = getattr(settings, 'GEOJSON_REST_JSON_BACKEND', None)
+    if name not in _backends:
+        if name is not None:
+            try:
+                _backends[name] = load_backend(name)
+            except ImportError:
+                raise ImproperlyConfigured('The json library %s is not installed'
+                                           % name)
+            except TypeError:
+                raise ImproperlyConfigured('The installed version of the json library %s is not supported'
+                                           % name)
+        else:
+            for auto_name in AUTO_BACKENDS:
+                try:
+                    backend = load_backend(auto_name)
+                except (ImportError, TypeError):
+                    # not installed or a version that can not be used
+                    continue
+                # a library that rounds floats is used only if configured
+                if getattr(backend, 'precise', True):
+                    _backends[name] = backend
+                    break
+    return _backends[name]
+
+def dumps(obj):
+    return get_backend().dumps(obj)
+
+def loads(json_str):
+    return get_backend().loads(json_str)
@@ -0,0 +1,37 @@
+"""
+This command reports the hit and miss statistics of the
+feature collection cache.
+"""
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from geojson_rest import featurecache
+
+
+class Command(BaseCommand):
+    help = ("Reports the hits, misses and stampede waits of the "
+            "feature collection cache.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--reset', action='store_true', dest='reset',
+            default=False, help='Set the counters to zero after reporting.'),
+    )
+
+    def handle(self, *args, **options):
+        if not featurecache.is_enabled():
+            self.stdout.write('The cache is disabled, set GEOJSON_REST_CACHE_ENABLED '
+                              'to use it')
+
+        stats = featurecache.get_stats()
+        requests = stats['hits'] + stats['misses']
+        if requests > 0:
+            hit_ratio = 100.0 * stats['hits'] / requests
+        else:
+            hit_ratio = 0.0
+        self.stdout.write('hits: %i, misses: %i, waits: %i, hit ratio: %.1f%%' % (
+                stats['hits'],
+                stats['misses'],
+                stats['waits'],
+                hit_ratio))
+
+        if options['reset']:
+            featurecache.reset_stats()
@@ -0,0 +1,217 @@
+"""
+This command rebuilds or verifies the cached json fragments
+of the features and properties.
+"""
+import multiprocessing
+import time
+from itertools import imap
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import Max
+from django.db.models import Min
+from django.db.models import Q
+from geojson_rest.models import bulk_update_json_str
+from geojson_rest.models import Feature
+from geojson_rest.models import FeatureProjection
+from geojson_rest.models import GroupVersion
+from geojson_rest.models import Property
+from geojson_rest.models import PropertySchemaKey
+from geojson_rest.models import PropertyValue
+from geojson_rest.models import SimplifiedGeometry
+
+MODELS = {
+    'property': Property,
+    'feature': Feature,
+}
+
+
+class Command(BaseCommand):
+    help = ("Rebuilds the cached json fragments of features and properties. "
+            "With --verify the caches are only compared and the "
+            "mismatches reported.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--model', action='store', dest='model',
+            default='all', choices=['all', 'feature', 'property'],
+            help='Which caches to rebuild: feature, property or all.'),
+        make_option('--group', action='store', dest='group',
+            default=None, help='Rebuild only the given group.'),
+        make_option('--user', action='store', dest='user',
+            default=None, help='Rebuild only the given username.'),
+        make_option('--min-id', action='store', dest='min_id',
+            type='int', default=None, help='Smallest id to rebuild.'),
+        make_option('--max-id', action='store', dest='max_id',
+            type='int', default=None, help='Largest id to rebuild.'),
+        make_option('--only-empty', action='store_true', dest='only_empty',
+            default=False, help='Rebuild only the empty caches.'),
+        make_option('--values', action='store_true', dest='values',
+            default=False, help='Rebuild also the property values '
+                                'used in the property filters.'),
+        make_option('--schema', action='store_true', dest='schema',
+            default=False, help='Register also the property keys in the '
+                                'schema registry of their groups.'),
+        make_option('--simplifications', action='store_true',
+            dest='simplifications', default=False,
+            help='Rebuild also the simplified geometries of the features.'),
+        make_option('--verify', action='store_true', dest='verify',
+            default=False, help='Report the stale caches without '
+                                'writing anything.'),
+        make_option('--workers', action='store', dest='workers',
+            type='int', default=1, help='Number of worker processes.'),
+        make_option('--chunk-size', action='store', dest='chunk_size',
+            type='int', default=1000, help='Number of ids handled and '
+                                           'written at a time.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1 or options['chunk_size'] < 1:
+            raise CommandError('--workers and --chunk-size should be positive')
+
+        if options['model'] == 'all':
+            model_names = ['property', 'feature']
+        else:
+            model_names = [options['model']]
+
+        for model_name in model_names:
+            self.rebuild(model_name, options)
+
+    def rebuild(self, model_name, options):
+        """
+        This function splits the id space of the model into
+        chunks and rebuilds them in the worker processes.
+        """
+        limits = get_queryset(model_name, options).aggregate(Min('id'),
+                                                             Max('id'))
+        if limits['id__min'] is None:
+            self.stdout.write('%s: nothing to rebuild' % model_name)
+            return
+
+        chunk_size = options['chunk_size']
+        tasks = [(model_name, options, start, start + chunk_size)
+                 for start in xrange(limits['id__min'],
+                                     limits['id__max'] + 1,
+                                     chunk_size)]
+
+        if options['workers'] > 1:
+            # the worker processes must not share the connection
+            connection.close()
+            pool = multiprocessing.Pool(options['workers'])
+            results = pool.imap_unordered(rebuild_chunk, tasks)
+        else:
+            pool = None
+            results = imap(rebuild_chunk, tasks)
+
+        start_time = time.time()
+        report_time = start_time
+        rows = 0
+        stale_ids = []
+        stale_groups = set()
+        for index, (chunk_rows, chunk_stale_ids, chunk_groups) in enumerate(results):
+            rows += chunk_rows
+            stale_ids.extend(chunk_stale_ids)
+            stale_groups.update(chunk_groups)
+            if time.time() - report_time > 5 or index + 1 == len(tasks):
+                report_time = time.time()
+                self.stdout.write('%s: %i/%i chunks, %i rows, %i stale, %.0f rows/s' % (
+                        model_name,
+                        index + 1,
+                        len(tasks),
+                        rows,
+                        len(stale_ids),
+                        rows / max(report_time - start_time, 0.001)))
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        if options['verify']:
+            if len(stale_ids) > 0:
+                self.stdout.write('%s: stale caches in ids %s' % (
+                        model_name,
+                        ', '.join([str(stale_id) for stale_id in sorted(stale_ids)])))
+        else:
+            # clients holding the stale representations should reload them
+            for group in stale_groups:
+                GroupVersion.bump(group)
+
+
+def get_queryset(model_name, options):
+    """
+    This function returns the rows of the model limited
+    by the command options.
+    """
+    queryset = MODELS[model_name].objects.all()
+    if options['group'] is not None:
+        queryset = queryset.filter(group = options['group'])
+    if options['user'] is not None:
+        queryset = queryset.filter(user__username = options['user'])
+    if options['min_id'] is not None:
+        queryset = queryset.filter(id__gte = options['min_id'])
+    if options['max_id'] is not None:
+        queryset = queryset.filter(id__lte = options['max_id'])
+    if options['only_empty']:
+        if model_name == 'feature':
+            queryset = queryset.filter(Q(json_str = '') | Q(geometry_json = ''))
+        else:
+            queryset = queryset.filter(json_str = '')
+    return queryset
+
+def rebuild_chunk(task):
+    """
+    This function serializes the rows of one id range and
+    writes the changed json fragments with one bulk update
+    for each field.
+
+    returns a tuple of the number of rows, the ids of the
+    stale caches and the groups of the stale caches
+    """
+    model_name, options, start, end = task
+    queryset = get_queryset(model_name, options)
+    queryset = queryset.filter(id__gte = start, id__lt = end)
+    if model_name == 'feature':
+        queryset = queryset.select_related('user', 'time')
+    else:
+        queryset = queryset.select_related('user', 'time', 'json_data')
+
+    rows = 0
+    fragments = {}
+    stale_ids = set()
+    stale_groups = set()
+    for obj in queryset:
+        rows += 1
+        for field, value in obj.get_fragments().items():
+            if value != getattr(obj, field):
+                fragments.setdefault(field, {})[obj.id] = value
+                stale_ids.add(obj.id)
+                stale_groups.add(obj.group)
+
+    if not options['verify']:
+        for field, json_strs in fragments.items():
+            bulk_update_json_str(MODELS[model_name], json_strs, field)
+        if model_name == 'property' and options['values']:
+            PropertyValue.objects.filter(property__in = [prop.id
+                                                         for prop in queryset]).delete()
+            PropertyValue.objects.bulk_create(
+                [value
+                 for prop in queryset
+                 for value in PropertyValue.from_json(prop,
+                                                      prop.json_data.json())])
+        if model_name == 'property' and options['schema']:
+            group_properties = {}
+            for prop in queryset:
+                group_properties.setdefault(prop.group, []).append(prop.json_data.json())
+            for group, properties_list in group_properties.items():
+                PropertySchemaKey.register(group, properties_list)
+        if model_name == 'feature' and 'geometry_json' in fragments:
+            FeatureProjection.objects.filter(feature__in = fragments['geometry_json'].keys()).delete()
+        if model_name == 'feature' and options['simplifications']:
+            SimplifiedGeometry.objects.filter(feature__in = [feat.id
+                                                             for feat in queryset]).delete()
+            SimplifiedGeometry.objects.bulk_create(
+                [simplified
+                 for feat in queryset
+                 for simplified in SimplifiedGeometry.from_feature(feat)])
+
+    return (rows, list(stale_ids), stale_groups)
@@ -0,0 +1,15 @@
+"""
+This command recomputes the feature counters used by the
+featurecount view from the features.
+"""
+from django.core.management.base import BaseCommand
+from geojson_rest.models import FeatureCounter
+
+
+class Command(BaseCommand):
+    help = ("Recomputes the feature counters of all groups by counting "
+            "the features and reports how many counters were wrong.")
+
+    def handle(self, *args, **options):
+        wrong = FeatureCounter.reconcile()
+        self.stdout.write('%i feature counters were corrected' % wrong)
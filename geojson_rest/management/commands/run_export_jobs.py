@@ -0,0 +1,75 @@
+"""
+This command runs the pending export jobs in the background.
+"""
+import multiprocessing
+import os
+import socket
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connection
+from geojson_rest.exports import run_job
+from geojson_rest.models import ExportJob
+
+
+class Command(BaseCommand):
+    help = ("Runs the pending export jobs and writes their files. "
+            "Several workers can be run at the same time, each job is "
+            "claimed by one of them.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', dest='once',
+            default=False, help='Exit when there are no pending jobs.'),
+        make_option('--interval', action='store', dest='interval',
+            type='float', default=5, help='Seconds to wait between the '
+                                          'polls for new jobs.'),
+        make_option('--workers', action='store', dest='workers',
+            type='int', default=1, help='Number of worker processes.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1 or options['interval'] < 0:
+            raise CommandError('--workers should be positive and --interval '
+                               'not negative')
+
+        if options['workers'] == 1:
+            self.work(options)
+            return
+
+        # the worker processes must not share the connection
+        connection.close()
+        processes = [multiprocessing.Process(target = self.work,
+                                             args = (options,))
+                     for i in range(options['workers'])]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+    def work(self, options):
+        """
+        This function claims and runs jobs until there are no
+        pending jobs with --once, otherwise forever.
+        """
+        worker = '%s:%i' % (socket.gethostname(), os.getpid())
+        while True:
+            job = ExportJob.claim(worker)
+            if job is not None:
+                if run_job(job):
+                    self.stdout.write('%s: export %i of %s written, %i rows' % (
+                            worker,
+                            job.id,
+                            job.group,
+                            job.rows))
+                else:
+                    self.stdout.write('%s: export %i of %s failed' % (
+                            worker,
+                            job.id,
+                            job.group))
+            elif options['once']:
+                return
+            else:
+                # do not keep a connection open while idle
+                connection.close()
+                time.sleep(options['interval'])
@@ -1,16 +1,325 @@
+import operator
+from datetime import timedelta
+from django.db import connection
+from django.db import IntegrityError
 from django.db import models
+from django.db.models import Count
+from django.db.models import F
+from django.db.models import Max
+from django.db.models import Q
+from django.db.models import Sum
+from django.db import transaction
 from django.core.urlresolvers import reverse
 from django.conf import settings
 from django.contrib.gis.db import models as gismodels
 #from django.contrib.gis.gdal import OGRGeometry
-from django.contrib.gis.geos import GEOSGeometry
 from django.contrib.auth.models import User
-from django.utils import simplejson as json
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from geonition_utils.models import JSON
 from geonition_utils.models import TimeD
+from geojson_rest import jsonbackend as json
+from geojson_rest.geometry import from_geojson
+from geojson_rest.geometry import get_srid
+from geojson_rest.geometry import to_geojson
+from geojson_rest.utils import flatten_json
+from geojson_rest.utils import json_schema
+from geojson_rest.utils import zoom_resolution
+
+
+def bulk_update_json_str(model, json_strs, field = 'json_str'):
+    """
+    This function saves the json_str caches given as a
+    dictionary from id to json_str with one UPDATE statement.
+
+    field -- the name of the text field to update
+    """
+    if len(json_strs) == 0:
+        return
+    
+    qn = connection.ops.quote_name
+    pk_column = qn(model._meta.pk.column)
+    params = []
+    for pk, json_str in json_strs.items():
+        params.extend([pk, json_str])
+    params.extend(json_strs.keys())
+    sql = 'UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (
+        qn(model._meta.db_table),
+        qn(model._meta.get_field(field).column),
+        pk_column,
+        ' '.join(['WHEN %s THEN %s'] * len(json_strs)),
+        pk_column,
+        ', '.join(['%s'] * len(json_strs)))
+    
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    transaction.commit_unless_managed()
+
+
+def compose_properties(property_json_strs):
+    """
+    This function returns the properties member of a feature
+    composed from the json_str fragments of its properties.
+
+    The later properties override the keys of the earlier
+    ones like in FeatureBase.get_properties.
+    """
+    if len(property_json_strs) == 0:
+        return '{}'
+    elif len(property_json_strs) == 1:
+        return property_json_strs[0]
+    
+    properties = {}
+    for json_str in property_json_strs:
+        properties.update(json.loads(json_str))
+    return json.dumps(properties)
+
+def compose_feature_json(json_str, geometry_json, property_json_strs):
+    """
+    This function returns the json of a feature composed by
+    concatenating its fragments.
+
+    json_str -- the json of the feature without the geometry
+                and the properties
+    geometry_json -- the geojson geometry
+    property_json_strs -- the json_str of each property of the
+                          feature in id order
+    """
+    return '%s, "properties": %s, "geometry": %s}' % (json_str[:-1],
+                                                       compose_properties(property_json_strs),
+                                                       geometry_json)
+
+
+def unique_in_order(items):
+    """
+    This function returns the items without duplicates in
+    the order they were first given.
+    """
+    seen = set()
+    unique = []
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            unique.append(item)
+    return unique
+
+def get_feature_geometry(feature):
+    """
+    This function returns the geometry of a geojson feature
+    as a GEOSGeometry in the coordinate reference system given
+    in the crs of the feature.
+    """
+    return from_geojson(feature['geometry'], get_srid(feature))
+
+def reserve_ids(model, count):
+    """
+    This function reserves count primary keys from the
+    sequence of the model table, so that related objects
+    can be created with bulk_create.
+
+    returns a list of ids or None if the database does
+    not support reserving them
+    """
+    if connection.vendor != 'postgresql':
+        return None
+    
+    cursor = connection.cursor()
+    cursor.execute('SELECT nextval(pg_get_serial_sequence(%s, %s)) '
+                   'FROM generate_series(1, %s)',
+                   [model._meta.db_table, model._meta.pk.column, count])
+    return [row[0] for row in cursor.fetchall()]
+
+
+class GroupVersion(models.Model):
+    """
+    This model keeps a version of each group that is increased
+    whenever a feature or property in the group is written.
+
+    It is used for conditional GET requests so that unchanged
+    groups can be answered without querying the features.
+
+    group -- the group the version belongs to
+    version -- counter increased on every write to the group
+    modified -- the time of the latest write to the group
+    """
+    group = models.CharField(max_length = 50,
+                             unique = True)
+    version = models.IntegerField(default = 0)
+    modified = models.DateTimeField()
+
+    @classmethod
+    def bump(cls, group):
+        """
+        This function increases the version of the group.
+        """
+        now = timezone.now()
+        if cls.objects.filter(group = group).update(version = F('version') + 1,
+                                                    modified = now) > 0:
+            return
+        
+        # first write to the group, another request might create it too
+        sid = transaction.savepoint()
+        try:
+            cls.objects.create(group = group,
+                               version = 1,
+                               modified = now)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            cls.objects.filter(group = group).update(version = F('version') + 1,
+                                                     modified = now)
+    
+    @classmethod
+    def get_version(cls, group):
+        """
+        This function returns the version and the modification
+        time of the group, the group '@all' combines all groups.
+
+        returns a (version, modified) tuple, (0, None) for groups
+        that have not been written to
+        """
+        if group == '@all':
+            aggregate = cls.objects.aggregate(version = Sum('version'),
+                                              modified = Max('modified'))
+            return (aggregate['version'] or 0, aggregate['modified'])
+        
+        try:
+            group_version = cls.objects.get(group = group)
+            return (group_version.version, group_version.modified)
+        except cls.DoesNotExist:
+            return (0, None)
+    
+    def __unicode__(self):
+        return u'%s %i' % (self.group, self.version)
+
+
+class FeatureCounter(models.Model):
+    """
+    This model keeps the number of features in each group so
+    that the features do not have to be counted on every
+    request.
+
+    The counters are kept for the whole group (user and private
+    null), for the private and public features of the group
+    (user null) and for the private and public features of each
+    user in the group. The count of a selection is the sum of
+    its rows. Concurrent first writes may create more than one
+    row for a counter, later changes are added only to the row
+    with the lowest id so the sum stays correct.
+
+    group -- the group that is counted
+    user -- the owner of the counted features, null for all users
+    private -- the visibility of the counted features, null for both
+    count -- the number of features
+    """
+    group = models.CharField(max_length = 50,
+                             db_index = True)
+    user = models.ForeignKey(User,
+                             null = True,
+                             blank = True)
+    private = models.NullBooleanField()
+    count = models.IntegerField(default = 0)
+
+    class Meta:
+        index_together = [['group', 'user', 'private']]
+
+    @classmethod
+    def add(cls, group, changes):
+        """
+        This function adds the changes to the counters of the
+        group, it should be called in the transaction that
+        creates or deletes the features.
+
+        changes -- list of (user_id, private, delta) tuples
+        """
+        # the rows are always locked in the same order
+        for (user_id, private), delta in sorted(cls.get_deltas(changes).items()):
+            if delta == 0:
+                continue
+            counter = cls.objects.filter(group = group,
+                                         user = user_id,
+                                         private = private).order_by('id').values('id')[:1]
+            updated = cls.objects.filter(id__in = counter).update(count = F('count') + delta)
+            if updated == 0:
+                cls.objects.create(group = group,
+                                   user_id = user_id,
+                                   private = private,
+                                   count = delta)
+
+    @classmethod
+    def get_deltas(cls, changes):
+        """
+        This function returns the changes of each counter
+        row as a dictionary from (user_id, private) to delta.
+        """
+        deltas = {}
+        for user_id, private, delta in changes:
+            for key in ((None, None),
+                        (None, bool(private)),
+                        (user_id, bool(private))):
+                deltas[key] = deltas.get(key, 0) + delta
+        return deltas
+
+    @classmethod
+    def get_count(cls, group, username = None, private = None):
+        """
+        This function returns the number of features in the
+        group, optionally only of the given user or visibility.
+        """
+        counters = cls.objects.filter(group = group)
+        if username is not None:
+            counters = counters.filter(user__username = username)
+        else:
+            counters = counters.filter(user = None)
+        if private is not None:
+            counters = counters.filter(private = private)
+        elif username is None:
+            counters = counters.filter(private = None)
+        return counters.aggregate(count = Sum('count'))['count'] or 0
+
+    @classmethod
+    def get_counts(cls):
+        """
+        This function returns the counters summed by their
+        group, user id and visibility as a dictionary.
+        """
+        counts = {}
+        for row in cls.objects.values('group', 'user', 'private').annotate(total = Sum('count')):
+            counts[(row['group'], row['user'], row['private'])] = row['total']
+        return counts
+
+    @classmethod
+    def reconcile(cls):
+        """
+        This function recomputes all the counters by counting
+        the features.
+
+        returns the number of counters that were wrong
+        """
+        with transaction.commit_on_success():
+            old_counts = cls.get_counts()
+            changes = {}
+            for row in Feature.objects.values('group', 'user', 'private').annotate(total = Count('id')):
+                changes.setdefault(row['group'], []).append((row['user'],
+                                                             row['private'],
+                                                             row['total']))
+            cls.objects.all().delete()
+            cls.objects.bulk_create([cls(group = group,
+                                         user_id = user_id,
+                                         private = private,
+                                         count = count)
+                                     for group, group_changes in changes.items()
+                                     for (user_id, private), count
+                                     in cls.get_deltas(group_changes).items()])
+            new_counts = cls.get_counts()
+
+        return len([key
+                    for key in set(old_counts.keys()) | set(new_counts.keys())
+                    if old_counts.get(key, 0) != new_counts.get(key, 0)])
+
+    def __unicode__(self):
+        return u'%s %s %s %i' % (self.group, self.user_id, self.private, self.count)
 
-from shapely.geometry import asShape
 
 class Property(models.Model):
     """
@@ -38,7 +347,7 @@ class Property(models.Model):
         if self.json_str:
             return self.json_str
         self.json_str = json.dumps(self.to_json())
-        self.save()
+        self.save(update_fields = ['json_str'])
         return self.json_str
 
     def create(self, properties, *args, **kwargs):
@@ -54,19 +363,58 @@ class Property(models.Model):
         self.time = timed
         super(Property, self).save(*args, **kwargs)
 
-        # kind of a cache for json
-        self.json_str = json.dumps(self.to_json())
-        super(Property, self).save(*args, **kwargs)
+        # kind of a cache for json, the id is known only after the insert
+        self.json_str = self.to_json_str()
+        super(Property, self).save(update_fields = ['json_str'])
+        PropertyValue.objects.bulk_create(PropertyValue.from_json(self, properties))
+        PropertySchemaKey.register(self.group, [properties])
+        GroupVersion.bump(self.group)
 
     def update(self, properties, *args, **kwargs):
-        new_json = json.loads(self.json_data.json_string)
+        """
+        This function updates the properties and bumps the
+        version of the group in one transaction.
+        """
+        with transaction.commit_on_success():
+            if self.write_properties(properties):
+                GroupVersion.bump(self.group)
+
+    def write_properties(self, properties):
+        """
+        This function merges the given properties into the
+        stored ones and writes the JSON, the json_str and the
+        values of this property once, only if they changed.
+
+        returns True if the properties changed
+        """
+        new_json = self.json_data.json()
         new_json.update(properties)
-        self.json_data.json_string = json.dumps(new_json)
-        self.json_data.save()
+        json_string = json.dumps(new_json)
+        if json_string == self.json_data.json_string:
+            return False
+        
+        self.json_data.json_string = json_string
+        self.json_data.save(update_fields = ['json_string'])
 
         # kind of a cache for json
-        self.json_str = json.dumps(self.to_json())
-        super(Property, self).save(*args, **kwargs)
+        self.json_str = self.to_json_str()
+        super(Property, self).save(update_fields = ['json_str'])
+        self.update_values(new_json)
+        PropertySchemaKey.register(self.group, [properties])
+        return True
+
+    def update_values(self, properties = None):
+        """
+        This function replaces the PropertyValue rows of
+        this property with the current values.
+
+        properties -- the current properties if they are
+                      already parsed
+        """
+        if properties is None:
+            properties = self.json_data.json()
+        self.values.all().delete()
+        PropertyValue.objects.bulk_create(PropertyValue.from_json(self, properties))
 
     def to_json(self):
         if self.time.expire_time == None:
@@ -82,9 +430,35 @@ class Property(models.Model):
                         'group': self.group })
         return retval
 
+    def to_json_str(self):
+        return json.dumps(self.to_json())
+
+    @classmethod
+    def get_schema_selectors(cls, queryset):
+        """
+        This function returns the csv selectors of the
+        properties in the queryset from the schema registry
+        of their groups, without reading the properties.
+        """
+        groups = queryset.order_by().values_list('group', flat = True).distinct()
+        return unique_in_order(PropertySchemaKey.get_keys(groups) +
+                                ['id',
+                                 'user',
+                                 'group',
+                                 'time.create_time',
+                                 'time.expire_time'])
+
+    def get_fragments(self):
+        """
+        This function returns the cached fragments of this
+        property as a dictionary from field name to value.
+        """
+        return {'json_str': self.to_json_str()}
+
     def delete(self, *args, **kwargs):
         
         super(Property, self).delete()
+        GroupVersion.bump(self.group)
     
     def get_create_time(self):
         return self.time.create_time.strftime('%Y-%m-%d %H:%M')
@@ -98,6 +472,158 @@ class Property(models.Model):
         unique_together = ('json_data', 'user', 'time')
 
 
+class PropertyValue(models.Model):
+    """
+    This model keeps the values of a property as key value
+    rows so that features can be filtered by their property
+    values in the database.
+
+    property -- the property the value belongs to
+    key -- the key of the value, the keys of nested objects
+           are joined with dots
+    value -- the value as text, booleans and null as in json
+    number -- the value as a number for numeric values
+    """
+    property = models.ForeignKey(Property, related_name = 'values')
+    key = models.CharField(max_length = 255)
+    value = models.CharField(max_length = 255)
+    number = models.FloatField(null = True)
+
+    @classmethod
+    def from_json(cls, prop, properties):
+        """
+        This function returns unsaved value rows for the
+        given property and its json properties.
+        """
+        values = []
+        for key, value in flatten_json(properties):
+            number = None
+            if isinstance(value, bool) or value is None:
+                text = json.dumps(value)
+            elif isinstance(value, (int, long, float)):
+                text = unicode(value)
+                number = value
+            else:
+                text = unicode(value)
+            values.append(cls(property = prop,
+                              key = key[:255],
+                              value = text[:255],
+                              number = number))
+        return values
+    
+    @classmethod
+    def match(cls, key, lookup, value):
+        """
+        This function returns the value rows with the key
+        that match the value with the lookup.
+
+        lookup -- one of exact, in, gt, gte, lt, lte, numeric
+                  values are compared as numbers
+        """
+        def equals(value):
+            try:
+                return Q(value = value) | Q(number = float(value))
+            except ValueError:
+                return Q(value = value)
+        
+        values = cls.objects.filter(key = key)
+        if lookup == 'exact':
+            return values.filter(equals(value))
+        elif lookup == 'in':
+            return values.filter(reduce(operator.or_,
+                                        [equals(item) for item in value.split(',')]))
+        elif lookup in ('gt', 'gte', 'lt', 'lte'):
+            try:
+                return values.filter(**{'number__%s' % lookup: float(value)})
+            except ValueError:
+                return values.filter(**{'value__%s' % lookup: value})
+        
+        raise ValueError('unknown lookup %s' % lookup)
+    
+    def __unicode__(self):
+        return u'%s=%s' % (self.key, self.value)
+
+    class Meta:
+        index_together = [['key', 'value'],
+                          ['key', 'number']]
+
+
+class PropertySchemaKey(models.Model):
+    """
+    This model is a registry of the property keys used in
+    each group and the json types of their values, so that
+    the schema of a group is known without reading all the
+    properties.
+
+    The keys are registered when properties are created or
+    updated and are never removed.
+
+    group -- the group of the properties
+    key -- the key of the value, the keys of nested objects
+           are joined with dots
+    value_type -- the json type of the values
+    """
+    group = models.CharField(max_length = 50)
+    key = models.CharField(max_length = 255)
+    value_type = models.CharField(max_length = 10)
+
+    @classmethod
+    def register(cls, group, properties_list):
+        """
+        This function adds the keys of the given properties
+        that are not yet registered in the group.
+
+        properties_list -- list of json property dictionaries
+        """
+        keys = unique_in_order([(key[:255], value_type)
+                                for properties in properties_list
+                                for key, value_type in json_schema(properties)])
+        if len(keys) == 0:
+            return
+
+        existing = set(cls.objects.filter(group = group,
+                                          key__in = [key for key, value_type in keys]).values_list('key',
+                                                                                                   'value_type'))
+        new_keys = [cls(group = group,
+                        key = key,
+                        value_type = value_type)
+                    for key, value_type in keys
+                    if (key, value_type) not in existing]
+        if len(new_keys) == 0:
+            return
+
+        # another request might register the same keys
+        sid = transaction.savepoint()
+        try:
+            cls.objects.bulk_create(new_keys)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            for new_key in new_keys:
+                sid = transaction.savepoint()
+                try:
+                    new_key.save()
+                    transaction.savepoint_commit(sid)
+                except IntegrityError:
+                    transaction.savepoint_rollback(sid)
+
+    @classmethod
+    def get_keys(cls, groups):
+        """
+        This function returns the registered keys of the groups
+        in the order they were first seen, as utf-8 encoded
+        csv selectors.
+        """
+        keys = cls.objects.filter(group__in = groups).order_by('id').values_list('key', flat = True)
+        return unique_in_order([key.encode('utf-8') for key in keys])
+
+    def __unicode__(self):
+        return u'%s %s %s' % (self.group, self.key, self.value_type)
+
+    class Meta:
+        unique_together = ('group', 'key', 'value_type')
+
+
 class FeatureBase(gismodels.Model):
     """
     This model represents a geographical feature.
@@ -116,24 +642,66 @@ class FeatureBase(gismodels.Model):
 
     objects = gismodels.GeoManager()
 
-    def get_properties(self):
+    def get_properties(self, property_entities = None):
         """
         This function returnes all the properties.
 
         overrides keys so be sure to save them in a way that
         that does not happen..
+
+        property_entities -- the properties of the feature if
+                             they are already loaded
         """
-        property_entities = self.properties.all()
+        if property_entities is None:
+            property_entities = self.properties.all()
         properties = {}
-        for prop in property_entities:
+        for prop in sorted(property_entities, key = lambda prop: prop.id):
             properties.update(prop.to_json())
 
         return properties
 
-    def to_json(self):
+    def to_json(self, property_entities = None):
         """
         This function return a dictionary representation
         of this object.
+
+        property_entities -- the properties of the feature if
+                             they are already loaded
+        """
+        json_obj = self.get_json_members()
+        json_obj['properties'] = self.get_properties(property_entities)
+        json_obj['geometry'] = json.loads(self.get_geometry_json())
+        return json_obj
+
+    def to_json_str(self, property_entities = None):
+        """
+        This function returns the json string representation
+        of this object composed from its fragments.
+
+        property_entities -- the properties of the feature if
+                             they are already loaded
+        """
+        if property_entities is None:
+            property_entities = self.properties.all()
+        return compose_feature_json(self.get_json_members_str(),
+                                    self.get_geometry_json(),
+                                    [prop.to_json_str()
+                                     for prop in sorted(property_entities,
+                                                        key = lambda prop: prop.id)])
+
+    def get_geometry_json(self):
+        """
+        This function returns the geometry as geojson text with
+        the coordinates rounded to GEOJSON_REST_COORDINATE_PRECISION
+        decimals if it is set.
+        """
+        return to_geojson(self.geometry,
+                          getattr(settings, 'GEOJSON_REST_COORDINATE_PRECISION', None))
+
+    def get_json_members(self):
+        """
+        This function returns the members of the json
+        representation except the geometry and properties.
         """
         if self.time.expire_time == None:
             exrtime = ''
@@ -143,8 +711,6 @@ class FeatureBase(gismodels.Model):
         json_obj = {
             'id': self.id,
             'private': self.private,
-            'geometry': json.loads(self.geometry.json),
-            'properties': self.get_properties(),
             'type': 'Feature',
             'time': {'create_time': self.time.create_time.isoformat(),
                      'expire_time': exrtime},
@@ -153,6 +719,9 @@ class FeatureBase(gismodels.Model):
         }
 
         return json_obj
+
+    def get_json_members_str(self):
+        return json.dumps(self.get_json_members())
     
     def get_absolute_url(self):
         return '%s/@all/@all/%i' % (reverse('feat'), self.id)
@@ -173,26 +742,273 @@ class Feature(FeatureBase):
     """
     this inherits form base and is the model
     that should be used for crud functionality
+
+    The json of the feature is cached in fragments that are
+    concatenated when the feature is read, so a change to a
+    property rewrites only the json_str of that property.
+
+    json_str -- the json without the geometry and properties
+    geometry_json -- the geojson of the geometry
     """
     json_str = models.TextField(blank=True)
+    geometry_json = models.TextField(blank=True)
     geometry = gismodels.GeometryField(srid = getattr(settings, 'SPATIAL_REFERENCE_SYSTEM_ID', 4326))
     properties = models.ManyToManyField(Property)
 
+    @classmethod
+    def get_schema_selectors(cls, queryset):
+        """
+        This function returns the csv selectors of the
+        features in the queryset, the properties are taken
+        from the schema registry of their groups.
+        """
+        return ['type',
+                'id',
+                'user',
+                'group',
+                'private',
+                'time.create_time',
+                'time.expire_time',
+                'geometry'] + \
+               ['properties.%s' % selector
+                for selector in Property.get_schema_selectors(queryset)]
+
     def get_json_str(self):
-        if self.json_str:
-            return self.json_str
-        self.json_str = json.dumps(self.to_json())
-        self.save()
-        return self.json_str
+        """
+        This function returns the json of the feature composed
+        from the cached fragments.
+        """
+        return self.get_json_strs([self.id])[self.id]
+    
+    @classmethod
+    def get_json_strs(cls, ids, srid = None, tolerance = None):
+        """
+        This function returns the json of the features with the
+        given ids as a dictionary from feature id to json string.
+        See compose_json_strs for srid and tolerance.
+        """
+        if len(ids) == 0:
+            return {}
+        
+        rows = cls.objects.filter(id__in = ids).values_list('id',
+                                                            'json_str',
+                                                            'geometry_json')
+        return cls.compose_json_strs(list(rows), srid, tolerance)
+    
+    @classmethod
+    def json_str_chunks(cls,
+                        queryset,
+                        srid = None,
+                        tolerance = None,
+                        chunk_size = None):
+        """
+        This function yields the json_str of the features in
+        the queryset as lists in id order.
+
+        See compose_json_strs for srid and tolerance.
+
+        The rows are read chunk_size at a time using the last id
+        of the previous chunk, so only one chunk is kept in memory
+        regardless of the size of the queryset.
+        """
+        if chunk_size is None:
+            chunk_size = getattr(settings, 'GEOJSON_REST_CHUNK_SIZE', 1000)
+        
+        queryset = queryset.order_by('id')
+        last_id = None
+        while True:
+            chunk = queryset
+            if last_id is not None:
+                chunk = chunk.filter(id__gt = last_id)
+            rows = list(chunk.values_list('id', 'json_str', 'geometry_json')[:chunk_size])
+            json_strs = cls.compose_json_strs(rows, srid, tolerance)
+            
+            yield [json_strs[row[0]] for row in rows]
+            
+            if len(rows) < chunk_size:
+                break
+            last_id = rows[-1][0]
+    
+    @classmethod
+    def compose_json_strs(cls, rows, srid = None, tolerance = None):
+        """
+        This function composes the json of the features from
+        their fragments, the empty fragments are filled first.
+
+        If srid is given and differs from the srid of the geometry
+        column the geometries are transformed and cached in
+        FeatureProjection.
+
+        If tolerance is given the geometries are replaced with the
+        precomputed simplified geometries of that tolerance.
+
+        rows -- list of (id, json_str, geometry_json) tuples
+        returns a dictionary from feature id to json string
+        """
+        if srid == cls._meta.get_field('geometry').srid:
+            srid = None
+        
+        ids = [row[0] for row in rows]
+        json_strs = dict([(row[0], row[1]) for row in rows])
+        geometries = dict([(row[0], row[2]) for row in rows])
+        missing = cls.fill_fragments([feat_id
+                                      for feat_id, json_str, geometry_json in rows
+                                      if not json_str or not geometry_json])
+        for feat_id, (json_str, geometry_json) in missing.items():
+            json_strs[feat_id] = json_str
+            geometries[feat_id] = geometry_json
+        
+        if srid is not None:
+            geometries.update(cls.get_projections(ids, srid))
+        if tolerance is not None:
+            simplified = SimplifiedGeometry.objects.filter(feature__in = ids,
+                                                           tolerance = tolerance)
+            if srid is not None:
+                simplified = simplified.transform(srid)
+            precision = getattr(settings, 'GEOJSON_REST_COORDINATE_PRECISION', None)
+            geometries.update([(simple.feature_id, to_geojson(simple.geometry,
+                                                              precision))
+                               for simple in simplified])
+        
+        property_json_strs = cls.get_property_json_strs(ids)
+        return dict([(feat_id, compose_feature_json(json_strs[feat_id],
+                                                    geometries[feat_id],
+                                                    property_json_strs.get(feat_id, [])))
+                     for feat_id in ids])
+    
+    @classmethod
+    def get_property_json_strs(cls, ids):
+        """
+        This function returns the json_str fragments of the
+        properties of the features with the given ids as a
+        dictionary from feature id to a list in property id order.
+        """
+        if len(ids) == 0:
+            return {}
+        
+        rows = cls.properties.through.objects.filter(feature__in = ids)
+        rows = list(rows.order_by('property__id').values_list('feature_id',
+                                                              'property_id',
+                                                              'property__json_str'))
+        missing = [property_id for feat_id, property_id, json_str in rows if not json_str]
+        if len(missing) > 0:
+            properties = Property.objects.filter(id__in = missing)
+            properties = properties.select_related('user', 'time', 'json_data')
+            missing = dict([(prop.id, prop.to_json_str()) for prop in properties])
+            # the empty caches are filled with one statement
+            bulk_update_json_str(Property, missing)
+        
+        property_json_strs = {}
+        for feat_id, property_id, json_str in rows:
+            property_json_strs.setdefault(feat_id, []).append(json_str or
+                                                              missing[property_id])
+        return property_json_strs
+    
+    @classmethod
+    def fill_fragments(cls, ids):
+        """
+        This function serializes the json_str and geometry_json
+        fragments of the features with the given ids and saves
+        them with one bulk update for each field.
+
+        returns a dictionary from feature id to a
+        (json_str, geometry_json) tuple
+        """
+        if len(ids) == 0:
+            return {}
+        
+        features = cls.objects.filter(id__in = ids).select_related('user', 'time')
+        fragments = dict([(feat.id, (feat.get_json_members_str(),
+                                     feat.get_geometry_json()))
+                          for feat in features])
+        bulk_update_json_str(cls, dict([(feat_id, fragment[0])
+                                        for feat_id, fragment in fragments.items()]))
+        bulk_update_json_str(cls,
+                             dict([(feat_id, fragment[1])
+                                   for feat_id, fragment in fragments.items()]),
+                             'geometry_json')
+        FeatureProjection.objects.filter(feature__in = ids).delete()
+        return fragments
+    
+    @classmethod
+    def invalidate(cls, ids):
+        """
+        This function marks the features with the given ids as
+        changed, e.g. after a property shared by them changed.
+
+        The properties are composed into the features when they
+        are read, so only the versions of the groups of the
+        features are bumped.
+        """
+        if len(ids) == 0:
+            return
+        
+        for group in cls.objects.filter(id__in = ids).values_list('group', flat = True).distinct():
+            GroupVersion.bump(group)
+    
+    @classmethod
+    def get_projections(cls, ids, srid):
+        """
+        This function returns the geometries of the features with
+        the given ids transformed to srid as a dictionary from
+        feature id to geojson.
+
+        The transformed geometries are cached in FeatureProjection
+        so the database transform and serialization is done only once.
+        """
+        projections = FeatureProjection.objects.filter(srid = srid,
+                                                       feature__in = ids)
+        json_strs = dict(projections.values_list('feature_id', 'json_str'))
+        missing = [feat_id for feat_id in ids if feat_id not in json_strs]
+        if len(missing) == 0:
+            return json_strs
+        
+        features = cls.objects.filter(id__in = missing).transform(srid)
+        new_projections = [FeatureProjection(feature_id = feat.id,
+                                             srid = srid,
+                                             json_str = feat.get_geometry_json())
+                           for feat in features]
+        
+        # another request might have cached the same features
+        sid = transaction.savepoint()
+        try:
+            FeatureProjection.objects.bulk_create(new_projections)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+        
+        json_strs.update([(projection.feature_id, projection.json_str)
+                          for projection in new_projections])
+        return json_strs
+    
+    def get_fragments(self):
+        """
+        This function returns the cached fragments of this
+        feature as a dictionary from field name to value.
+        """
+        return {'json_str': self.get_json_members_str(),
+                'geometry_json': self.get_geometry_json()}
     
     def update_json_str(self):
-        if self.json_str != json.dumps(self.to_json()):
-            self.json_str = json.dumps(self.to_json())
-            self.save()
-            return True
-        else:
+        """
+        This function rebuilds the json_str and geometry_json
+        fragments of this feature.
+
+        returns True if the fragments changed
+        """
+        fragments = self.get_fragments()
+        update_fields = [field
+                         for field, value in fragments.items()
+                         if getattr(self, field) != value]
+        for field, value in fragments.items():
+            setattr(self, field, value)
+        if len(update_fields) == 0:
             return False
-            
+        
+        self.save(update_fields = update_fields)
+        if 'geometry_json' in update_fields:
+            self.projections.all().delete()
+        return True
 
     def create(self, feature, *args, **kwargs):
         """
@@ -213,32 +1029,133 @@ class Feature(FeatureBase):
         "user": ...,
         "group": ...
         }
+
+        The feature and its counters are written in one
+        transaction.
         """
-        #TODO do not use GDAL
-#        self.geometry = OGRGeometry(json.dumps(feature['geometry'])).geos
-#        self.geometry = GEOSGeometry(json.dumps(feature['geometry']))
-        # There is a problem with GDAL from_json routine
-        # so we use shapely library to circumvent the problem.
-        temp_geom = asShape(feature['geometry'])
-        # Extract the Coordinate referense system of the feature
-        if 'crs' in feature.keys():
-            try:
-                feat_srid = int(feature['crs']['properties']['name'].split(':')[1])
-            except (IndexError, KeyError):
-                feat_srid = None
-        else:
-            feat_srid = None
-        self.geometry = GEOSGeometry(temp_geom.to_wkt(), feat_srid)
+        with transaction.commit_on_success():
+            self.create_rows(feature, *args, **kwargs)
+
+    def create_rows(self, feature, *args, **kwargs):
+        """
+        This function writes the rows of a new feature in the
+        current transaction, see create.
+        """
+        self.geometry = get_feature_geometry(feature)
+        self.geometry_json = self.get_geometry_json()
         self.private = feature.get('private', True)
         timed = TimeD()
         timed.save()
         self.time = timed
+        # the counter row is locked before the version row like in
+        # update and delete so that concurrent writes can not deadlock
+        FeatureCounter.add(self.group, [(self.user_id, self.private, 1)])
         prop = Property(user = self.user,
                         group = self.group)
         prop.create(feature['properties'])
         super(Feature, self).save(*args, **kwargs)
         self.properties.add(prop)
+        SimplifiedGeometry.objects.bulk_create(SimplifiedGeometry.from_feature(self))
+        GroupVersion.bump(self.group)
+
+
+    @classmethod
+    def create_collection(cls, features, user, group, crs = None):
+        """
+        This function creates all the features of a geojson
+        feature collection in one transaction.
+
+        The ids of the new rows are reserved beforehand so that
+        each table is written with one bulk_create instead of
+        saving every feature separately. Databases that cannot
+        reserve ids fall back to creating the features one by one.
 
+        features -- list of geojson features, see create
+        user -- the user that owns the features
+        group -- the group the features belong to
+        crs -- the crs of the feature collection, used for the
+               features that do not have a crs of their own
+
+        returns a list of the created features
+        """
+        if crs is not None:
+            features = [feature if 'crs' in feature else dict(feature, crs = crs)
+                        for feature in features]
+        
+        with transaction.commit_on_success():
+            count = len(features)
+            # both the feature and its property have their own time
+            time_ids = reserve_ids(TimeD, 2 * count)
+            if time_ids is None:
+                new_features = []
+                for feature in features:
+                    new_feature = cls(user = user,
+                                      group = group)
+                    new_feature.create_rows(feature)
+                    new_features.append(new_feature)
+                return new_features
+            
+            json_ids = reserve_ids(JSON, count)
+            property_ids = reserve_ids(Property, count)
+            feature_ids = reserve_ids(cls, count)
+            
+            now = timezone.now()
+            timeds = []
+            jsons = []
+            properties = []
+            new_features = []
+            for i, feature in enumerate(features):
+                feature_timed = TimeD(id = time_ids[i],
+                                      create_time = now)
+                property_timed = TimeD(id = time_ids[count + i],
+                                       create_time = now)
+                js = JSON(id = json_ids[i],
+                          json_string = json.dumps(feature['properties']),
+                          collection = 'properties')
+                prop = Property(id = property_ids[i],
+                                user = user,
+                                group = group,
+                                json_data = js,
+                                time = property_timed)
+                prop.json_str = prop.to_json_str()
+                new_feature = cls(id = feature_ids[i],
+                                  user = user,
+                                  group = group,
+                                  geometry = get_feature_geometry(feature),
+                                  private = feature.get('private', True),
+                                  time = feature_timed)
+                new_feature.json_str = new_feature.get_json_members_str()
+                new_feature.geometry_json = new_feature.get_geometry_json()
+                timeds.extend([feature_timed, property_timed])
+                jsons.append(js)
+                properties.append(prop)
+                new_features.append(new_feature)
+            
+            TimeD.objects.bulk_create(timeds)
+            JSON.objects.bulk_create(jsons)
+            Property.objects.bulk_create(properties)
+            PropertyValue.objects.bulk_create(
+                [value
+                 for i, new_property in enumerate(properties)
+                 for value in PropertyValue.from_json(new_property,
+                                                      features[i]['properties'])])
+            cls.objects.bulk_create(new_features)
+            SimplifiedGeometry.objects.bulk_create(
+                [simplified
+                 for created in new_features
+                 for simplified in SimplifiedGeometry.from_feature(created)])
+            cls.properties.through.objects.bulk_create(
+                [cls.properties.through(feature_id = feature_ids[i],
+                                        property_id = property_ids[i])
+                 for i in range(count)])
+            PropertySchemaKey.register(group,
+                                       [feature['properties'] for feature in features])
+            FeatureCounter.add(group,
+                               [(user.id, created.private, 1)
+                                for created in new_features])
+            GroupVersion.bump(group)
+        
+        return new_features
 
     def update(self, feature, user, *args, **kwargs):
         """
@@ -248,27 +1165,267 @@ class Feature(FeatureBase):
         only some values can be updated:
         private -- can be updated by the creator of the feature
         properties -- can be updated by all (saved separate per user)
-        """
-        if self.user == user:
-            self.private = feature.get('private', True)
-            old_property = self.properties.get(user = user)
-            old_property.update(feature['properties'])
-            self.save(*args, **kwargs)
 
-        else:
-            try:
-                old_property = self.properties.get(user = user)
-                old_property.update(feature['properties'])
-            except Property.DoesNotExist:
+        All the writes are done in one transaction, each row is
+        written at most once and only if its content changed.
+        """
+        with transaction.commit_on_success():
+            update_fields = []
+            if self.user == user:
+                private = feature.get('private', True)
+                if private != self.private:
+                    # the feature moves between the counters
+                    FeatureCounter.add(self.group,
+                                       [(self.user_id, self.private, -1),
+                                        (self.user_id, private, 1)])
+                    self.private = private
+                    update_fields.append('private')
+            
+            # the properties are composed into the json of the feature
+            # when it is read, so only the property fragment is written
+            user_properties = list(self.properties.filter(user = user).select_related('user',
+                                                                                     'time',
+                                                                                     'json_data'))
+            if len(user_properties) > 0:
+                changed = user_properties[0].write_properties(feature['properties'])
+            elif self.user == user:
+                raise Property.DoesNotExist('The feature has no properties of its creator')
+            else:
                 prop = Property(user = user,
                                 group = self.group)
-                prop.create(feature['properties'], user)
+                prop.create(feature['properties'])
                 self.properties.add(prop)
-        # kind of a cache for json
-        self.json_str = json.dumps(self.to_json())
-        self.save(*args, **kwargs)
+                changed = True
+            
+            if len(update_fields) > 0:
+                # kind of a cache for json
+                self.json_str = self.get_json_members_str()
+                update_fields.append('json_str')
+                self.save(update_fields = update_fields)
+            if changed or len(update_fields) > 0:
+                GroupVersion.bump(self.group)
 
     def delete(self, *args, **kwargs):
-        Property.objects.filter(feature__id=self.id).delete()
-        super(Feature, self).delete()
+        with transaction.commit_on_success():
+            Property.objects.filter(feature__id=self.id).delete()
+            super(Feature, self).delete()
+            FeatureCounter.add(self.group, [(self.user_id, self.private, -1)])
+            GroupVersion.bump(self.group)
+
+    class Meta:
+        # the last expiry of a group is looked up on every @now request
+        index_together = [['group', 'time']]
+
+
+class FeatureProjection(models.Model):
+    """
+    This model caches the geojson of the geometry of a feature
+    transformed to another spatial reference system.
+
+    The cached json is removed whenever the geometry_json of
+    the feature changes.
 
+    feature -- the feature that was transformed
+    srid -- the spatial reference system of the geometry
+    json_str -- the geojson of the transformed geometry
+    """
+    feature = models.ForeignKey(Feature, related_name = 'projections')
+    srid = models.IntegerField()
+    json_str = models.TextField()
+
+    class Meta:
+        unique_together = ('feature', 'srid')
+
+
+class SimplifiedGeometry(gismodels.Model):
+    """
+    This model keeps topology preserving simplifications of
+    the geometry of a feature, one for each tolerance in
+    GEOJSON_REST_SIMPLIFY_TOLERANCES, to be served for
+    overview maps instead of the full geometry.
+
+    Points and geometries that the simplification would not
+    reduce have no rows.
+
+    feature -- the feature the geometry was simplified from
+    tolerance -- the tolerance of the simplification in the
+                 units of the geometry column
+    geometry -- the simplified geometry
+    """
+    feature = models.ForeignKey(Feature, related_name = 'simplifications')
+    tolerance = models.FloatField()
+    geometry = gismodels.GeometryField(srid = getattr(settings, 'SPATIAL_REFERENCE_SYSTEM_ID', 4326))
+
+    objects = gismodels.GeoManager()
+
+    @classmethod
+    def get_tolerances(cls):
+        """
+        This function returns the precomputed tolerances in
+        descending order, by default the resolutions of the
+        zoom levels 4, 8 and 12.
+        """
+        srid = cls._meta.get_field('geometry').srid
+        tolerances = getattr(settings,
+                             'GEOJSON_REST_SIMPLIFY_TOLERANCES',
+                             [zoom_resolution(zoom, srid) for zoom in (4, 8, 12)])
+        return sorted(tolerances, reverse = True)
+    
+    @classmethod
+    def get_tolerance(cls, tolerance):
+        """
+        This function returns the largest precomputed tolerance
+        that is not larger than the requested one or None if
+        the full geometry should be used.
+        """
+        for precomputed in cls.get_tolerances():
+            if precomputed <= tolerance:
+                return precomputed
+        return None
+    
+    @classmethod
+    def from_feature(cls, feature):
+        """
+        This function returns unsaved simplifications of the
+        geometry of the feature.
+        """
+        simplifications = []
+        if feature.geometry.geom_type in ('Point', 'MultiPoint'):
+            return simplifications
+        
+        num_coords = feature.geometry.num_coords
+        for tolerance in cls.get_tolerances():
+            geometry = feature.geometry.simplify(tolerance,
+                                                 preserve_topology = True)
+            if geometry.empty or geometry.num_coords >= num_coords:
+                continue
+            geometry.srid = feature.geometry.srid
+            simplifications.append(cls(feature_id = feature.id,
+                                       tolerance = tolerance,
+                                       geometry = geometry))
+        return simplifications
+
+    class Meta:
+        unique_together = ('feature', 'tolerance')
+
+
+class ExportJob(models.Model):
+    """
+    This model is an export of the features of a group that
+    is written to a compressed file in the background by the
+    run_export_jobs command.
+
+    group -- the group whose features are exported
+    format -- csv, geojson or geojsonseq
+    user -- the user that requested the export
+    status -- pending, running, done or failed
+    worker -- the worker process running or that ran the job
+    updated -- the latest progress of a running job
+    rows -- the number of features written so far
+    total_rows -- the number of features to write
+    file_path -- the compressed file when the job is done
+    error -- the error of a failed job
+    """
+    FORMATS = (
+        ('csv', _('csv')),
+        ('geojson', _('GeoJSON feature collection')),
+        ('geojsonseq', _('GeoJSON text sequence')),
+    )
+    STATUSES = (
+        ('pending', _('pending')),
+        ('running', _('running')),
+        ('done', _('done')),
+        ('failed', _('failed')),
+    )
+    group = models.CharField(max_length = 50)
+    format = models.CharField(max_length = 10,
+                              choices = FORMATS,
+                              default = 'csv')
+    user = models.ForeignKey(User,
+                             null = True,
+                             blank = True)
+    status = models.CharField(max_length = 10,
+                              choices = STATUSES,
+                              default = 'pending',
+                              db_index = True)
+    worker = models.CharField(max_length = 100,
+                              blank = True)
+    rows = models.IntegerField(default = 0)
+    total_rows = models.IntegerField(null = True,
+                                     blank = True)
+    file_path = models.CharField(max_length = 255,
+                                 blank = True)
+    error = models.TextField(blank = True)
+    created = models.DateTimeField(auto_now_add = True)
+    started = models.DateTimeField(null = True,
+                                   blank = True)
+    updated = models.DateTimeField(null = True,
+                                   blank = True)
+    finished = models.DateTimeField(null = True,
+                                    blank = True)
+
+    @classmethod
+    def claim(cls, worker):
+        """
+        This function marks the oldest pending job as running
+        in the given worker and returns it, None if there are
+        no pending jobs.
+
+        The status is changed with a conditional update, so a
+        job is claimed by only one of the workers polling at
+        the same time.
+        """
+        while True:
+            pending_ids = list(cls.objects.filter(status = 'pending').order_by('id').values_list('id', flat = True)[:10])
+            if len(pending_ids) == 0:
+                return None
+            for job_id in pending_ids:
+                now = timezone.now()
+                if cls.objects.filter(id = job_id,
+                                      status = 'pending').update(status = 'running',
+                                                                 worker = worker,
+                                                                 started = now,
+                                                                 updated = now) == 1:
+                    return cls.objects.get(id = job_id)
+
+    def add_rows(self, count):
+        """
+        This function records the progress of a running job.
+        """
+        self.rows += count
+        self.updated = timezone.now()
+        ExportJob.objects.filter(id = self.id).update(rows = F('rows') + count,
+                                                      updated = self.updated)
+
+    @classmethod
+    def get_requeueable(cls):
+        """
+        This function returns the jobs that can be run again,
+        the failed jobs and the running jobs that have made no
+        progress in GEOJSON_REST_EXPORT_STALE_TIMEOUT seconds
+        because their worker was stopped.
+        """
+        stale_time = timezone.now() - timedelta(
+            seconds = getattr(settings, 'GEOJSON_REST_EXPORT_STALE_TIMEOUT', 600))
+        return cls.objects.filter(Q(status = 'failed') |
+                                  Q(status = 'running', updated__lt = stale_time))
+
+    def finish(self, status, **kwargs):
+        """
+        This function records the end of the job with the
+        given status and the other fields given as keywords.
+        """
+        kwargs.update({'status': status,
+                       'finished': timezone.now()})
+        for field, value in kwargs.items():
+            setattr(self, field, value)
+        ExportJob.objects.filter(id = self.id).update(**kwargs)
+
+    def get_progress(self):
+        if not self.total_rows:
+            return u''
+        return u'%i %%' % (100 * self.rows / self.total_rows)
+    get_progress.short_description = _('progress')
+
+    def __unicode__(self):
+        return u'%s %s %s' % (self.group, self.format, self.status)
@@ -0,0 +1,275 @@
+"""
+This file contains an encoder for Mapbox Vector Tiles
+(specification version 2) used by the feature tile view.
+
+The protocol buffer messages are written directly so no
+external tile server or protobuf library is needed.
+"""
+import math
+import struct
+from django.contrib.gis.geos import Polygon
+
+# geometry types of the tile features
+POINT = 1
+LINESTRING = 2
+POLYGON = 3
+
+# geometry commands
+MOVE_TO = 1
+LINE_TO = 2
+CLOSE_PATH = 7
+
+# half of the width of the web mercator world in meters
+ORIGIN_SHIFT = math.pi * 6378137
+
+def tile_bounds(z, x, y):
+    """
+    This function returns the (minx, miny, maxx, maxy)
+    bounds of a tile in web mercator (EPSG:3857).
+    """
+    size = 2 * ORIGIN_SHIFT / 2 ** z
+    minx = -ORIGIN_SHIFT + x * size
+    maxy = ORIGIN_SHIFT - y * size
+    return (minx, maxy - size, minx + size, maxy)
+
+def varint(value):
+    """
+    This function returns the protocol buffer varint
+    encoding of a non negative integer.
+    """
+    data = []
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            data.append(chr(byte | 0x80))
+        else:
+            data.append(chr(byte))
+            return ''.join(data)
+
+def zigzag(value):
+    """
+    This function maps signed integers to unsigned ones
+    so that small negative values stay small.
+    """
+    return (value << 1) ^ (value >> 63)
+
+def field_key(number, wire_type):
+    return varint((number << 3) | wire_type)
+
+def length_delimited(number, data):
+    return field_key(number, 2) + varint(len(data)) + data
+
+def packed(number, values):
+    return length_delimited(number, ''.join([varint(value) for value in values]))
+
+def encode_value(value):
+    """
+    This function returns the encoded tile value message
+    of a property value.
+    """
+    if isinstance(value, bool):
+        return field_key(7, 0) + varint(int(value))
+    elif isinstance(value, (int, long)):
+        if value < 0:
+            return field_key(6, 0) + varint(zigzag(value))
+        return field_key(5, 0) + varint(value)
+    elif isinstance(value, float):
+        return field_key(3, 1) + struct.pack('<d', value)
+
+    if not isinstance(value, unicode):
+        value = unicode(value)
+    return length_delimited(1, value.encode('utf-8'))
+
+def tile_geometry(geometry, bounds, extent = 4096, buffer = 64):
+    """
+    This function clips the geometry to the tile bounds and
+    returns the tile geometry type and the geometry commands
+    in the integer coordinates of the tile, None if nothing
+    of the geometry is left in the tile.
+
+    geometry -- GEOSGeometry in the coordinates of the bounds
+    bounds -- (minx, miny, maxx, maxy) of the tile
+    extent -- the width of the tile in integer coordinates
+    buffer -- width of the border clipped outside the tile in
+              integer coordinates
+    """
+    minx, miny, maxx, maxy = bounds
+    scale = extent / (maxx - minx)
+    margin = buffer / scale
+    clip = Polygon.from_bbox((minx - margin,
+                              miny - margin,
+                              maxx + margin,
+                              maxy + margin))
+    clip.srid = geometry.srid
+    dimension = geometry.dims
+    if not clip.contains(geometry):
+        geometry = geometry.intersection(clip)
+    if geometry.empty:
+        return None
+
+    def quantize(coords):
+        return [(int(round((coord[0] - minx) * scale)),
+                 int(round((maxy - coord[1]) * scale)))
+                for coord in coords]
+
+    points = []
+    lines = []
+    polygons = []
+    parts = [geometry]
+    while len(parts) > 0:
+        part = parts.pop(0)
+        if part.geom_type == 'Point':
+            points.extend(quantize([part.coords]))
+        elif part.geom_type in ('LineString', 'LinearRing'):
+            lines.append(quantize(part.coords))
+        elif part.geom_type == 'Polygon':
+            polygons.append([quantize(ring.coords) for ring in part])
+        else:
+            parts.extend(part)
+
+    encoder = GeometryEncoder()
+    if dimension == 0 and len(points) > 0:
+        return (POINT, encoder.points(points))
+    elif dimension == 1:
+        commands = []
+        for line in lines:
+            commands.extend(encoder.line(line))
+        if len(commands) > 0:
+            return (LINESTRING, commands)
+    elif dimension == 2:
+        commands = []
+        for polygon in polygons:
+            commands.extend(encoder.polygon(polygon))
+        if len(commands) > 0:
+            return (POLYGON, commands)
+
+    return None
+
+
+class GeometryEncoder(object):
+    """
+    This class writes the geometry commands of one tile
+    feature, the coordinates are relative to the cursor
+    left by the previous command.
+    """
+    def __init__(self):
+        self.x = 0
+        self.y = 0
+
+    def command(self, command_id, count):
+        return (command_id & 0x7) | (count << 3)
+
+    def moves(self, coords):
+        params = []
+        for x, y in coords:
+            params.extend([zigzag(x - self.x), zigzag(y - self.y)])
+            self.x = x
+            self.y = y
+        return params
+
+    def points(self, coords):
+        return [self.command(MOVE_TO, len(coords))] + self.moves(coords)
+
+    def line(self, coords):
+        coords = remove_repeated(coords)
+        if len(coords) < 2:
+            return []
+        return ([self.command(MOVE_TO, 1)] +
+                self.moves(coords[:1]) +
+                [self.command(LINE_TO, len(coords) - 1)] +
+                self.moves(coords[1:]))
+
+    def ring(self, coords, exterior):
+        coords = remove_repeated(coords)
+        if len(coords) > 1 and coords[0] == coords[-1]:
+            coords = coords[:-1]
+        if len(coords) < 3:
+            return []
+        # exterior rings have a positive area in tile coordinates
+        area = ring_area(coords)
+        if area == 0:
+            return []
+        if (area > 0) != exterior:
+            coords.reverse()
+        return ([self.command(MOVE_TO, 1)] +
+                self.moves(coords[:1]) +
+                [self.command(LINE_TO, len(coords) - 1)] +
+                self.moves(coords[1:]) +
+                [self.command(CLOSE_PATH, 1)])
+
+    def polygon(self, rings):
+        commands = self.ring(rings[0], True)
+        if len(commands) == 0:
+            return []
+        for ring in rings[1:]:
+            commands.extend(self.ring(ring, False))
+        return commands
+
+
+def remove_repeated(coords):
+    result = []
+    for coord in coords:
+        if len(result) == 0 or result[-1] != coord:
+            result.append(coord)
+    return result
+
+def ring_area(coords):
+    """
+    This function returns twice the signed area of a ring
+    calculated with the surveyor's formula.
+    """
+    area = 0
+    for i in range(len(coords)):
+        x1, y1 = coords[i - 1]
+        x2, y2 = coords[i]
+        area += x1 * y2 - x2 * y1
+    return area
+
+def encode_layer(name, features, extent = 4096):
+    """
+    This function returns an encoded tile with one layer,
+    tiles with several layers are the concatenation of
+    their layers.
+
+    name -- the name of the layer
+    features -- list of (id, geometry type, geometry commands,
+                properties) tuples, properties is a dictionary
+                of scalar values
+    extent -- the width of the tile in integer coordinates
+    """
+    keys = []
+    key_indexes = {}
+    values = []
+    value_indexes = {}
+    layer = [field_key(15, 0) + varint(2),
+             length_delimited(1, name.encode('utf-8')),
+             field_key(5, 0) + varint(extent)]
+
+    for feature_id, geometry_type, commands, properties in features:
+        tags = []
+        for key, value in properties.items():
+            if value is None or isinstance(value, (dict, list)):
+                continue
+            if key not in key_indexes:
+                key_indexes[key] = len(keys)
+                keys.append(key)
+            # True and 1 are different values in the tile
+            value_key = (type(value), value)
+            if value_key not in value_indexes:
+                value_indexes[value_key] = len(values)
+                values.append(value)
+            tags.extend([key_indexes[key], value_indexes[value_key]])
+
+        layer.append(length_delimited(2,
+                                      field_key(1, 0) + varint(feature_id) +
+                                      packed(2, tags) +
+                                      field_key(3, 0) + varint(geometry_type) +
+                                      packed(4, commands)))
+
+    for key in keys:
+        layer.append(length_delimited(3, key.encode('utf-8')))
+    for value in values:
+        layer.append(length_delimited(4, encode_value(value)))
+
+    return length_delimited(3, ''.join(layer))
@@ -0,0 +1,6 @@
+-- indexes for the time limits of the feature queries
+-- syncdb runs this file only when it creates the feature table, on
+-- an existing database install the indexes with
+--   python manage.py sqlcustom geojson_rest | python manage.py dbshell
+CREATE INDEX geojson_rest_timed_create_time ON geonition_utils_timed (create_time);
+CREATE INDEX geojson_rest_timed_expire_time ON geonition_utils_timed (expire_time);
@@ -13,7 +13,19 @@ gnt.geo = {};
  group -- the group the features belong to, also allowed: '@all', '@self'
  limit_params -- string starting with '?'
     parameters in the get limiting parameters:
-    time -- the time the features was valid, also allowed '@now', '@all'
+    time -- the time the features was valid as an ISO 8601 timestamp,
+            also allowed '@now' (default), '@all'
+    bbox -- minx,miny,maxx,maxy[,srid] features overlapping the box
+    intersects -- geojson or WKT geometry the features should intersect
+    limit -- the maximum number of features to return in one page
+    cursor -- the cursor of the next page, the "next" link of the
+              collection contains it
+    srid -- the srid the geometries should be transformed to
+    simplify -- tolerance of the simplified geometries to return
+    zoom -- zoom level of the map to return simplified geometries for
+    prop.<key> -- value the property should have, nested keys are
+                  joined with dots and the key can end with __in,
+                  __gt, __gte, __lt or __lte e.g. prop.level__gte=3
 
 */
 gnt.geo.get_features =
@@ -86,12 +98,12 @@ function(user, group, feature_id, ajax_params) {
 };
 
 /*
- create_feature function saves a new feature, this function
- only saves one feature at the time. The function takes the
- following arguments:
+ create_feature function saves a new feature, a geojson
+ FeatureCollection can be given to save many features at once.
+ The function takes the following arguments:
  user -- the user that is saving the feature, '@me', '@all' reserved
  group -- the group the feature belongs to '@self', '@all' reserved
- feature -- geojson feature with additional parameters
+ feature -- geojson feature or feature collection with additional parameters
  ajax_params -- possibility to extend the ajax call with this json
  
  The feature can have the following parameters:
@@ -2,20 +2,51 @@
 # -*- coding: utf-8 -*-
 
 from actions import get_selectors
+import featurecache
+import jsonbackend
+from geometry import from_geojson
+from geometry import get_srid
+from geometry import to_geojson
+from geometry import to_wkt
+from mvt import tile_bounds
+from mvt import tile_geometry
+from models import ExportJob
 from models import Feature
+from models import FeatureCounter
+from models import FeatureProjection
+from models import GroupVersion
+from models import Property
+from models import PropertySchemaKey
+from models import SimplifiedGeometry
 from actions import download_csv
+from actions import download_geojsonseq
 from admin import FeatureAdmin
 from datetime import datetime
+from datetime import timedelta
 from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.contrib.gis.geos import GEOSGeometry
+from django.contrib.gis.geos import Point
 from django.core.urlresolvers import reverse
+from django.db import connection
 from django.test import TestCase
 from django.test.client import Client
 from django.test.utils import override_settings
 from django.utils import simplejson as json
+from django.utils import timezone
+from geonition_utils.models import JSON
+from geonition_utils.models import TimeD
+from StringIO import StringIO
 from time import sleep
 from django.utils.unittest import skip
 import csv
 import copy
+import gzip
+import os
+import shutil
+import tempfile
+import threading
 
 @override_settings(SPATIAL_REFERENCE_SYSTEM_ID = 4326)
 class GeoRESTTest(TestCase):
@@ -52,6 +83,27 @@ class GeoRESTTest(TestCase):
     def create_feature_collection(self):
         return copy.deepcopy(self.base_featurecollection)
 
+    def count_queries(self, func, *args, **kwargs):
+        # returns the number of queries made by calling func
+        return len(self.get_queries(func, *args, **kwargs))
+
+    def get_queries(self, func, *args, **kwargs):
+        # returns the sql of the queries made by calling func
+        old_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        try:
+            starting_queries = len(connection.queries)
+            func(*args, **kwargs)
+            return [query['sql'] for query in connection.queries[starting_queries:]]
+        finally:
+            connection.use_debug_cursor = old_debug_cursor
+
+    def count_updates(self, queries, model):
+        # returns the number of UPDATE statements to the table of model
+        table = connection.ops.quote_name(model._meta.db_table)
+        return len([sql for sql in queries
+                    if sql.startswith('UPDATE %s ' % table)])
+
     def test_unauthorized_feature_get(self):
         #login the user
         self.client.login(username = 'user1',
@@ -659,6 +711,49 @@ class GeoRESTTest(TestCase):
 
         self.assertFalse(response_json['features'][0]['properties']['first'])
 
+    def test_update_feature_writes(self):
+        self.client.login(username = 'user1',
+                          password = 'passwd')
+
+        new_feature = self.create_feature({'first': True})
+        response = self.client.post(reverse('feat'),
+                                    json.dumps(new_feature),
+                                    content_type = 'application/json')
+        feature_url = reverse('feat') + '/@me/@self/' + str(json.loads(response.content)['id'])
+
+        #each changed row is updated once
+        new_feature.update({'properties': {'first': False},
+                            'private': False})
+        queries = self.get_queries(self.client.put,
+                                   feature_url,
+                                   json.dumps(new_feature),
+                                   content_type = 'application/json')
+        self.assertEquals(self.count_updates(queries, Feature),
+                          1,
+                          'The feature was not updated exactly once')
+        self.assertEquals(self.count_updates(queries, Property),
+                          1,
+                          'The property was not updated exactly once')
+        self.assertEquals(self.count_updates(queries, JSON),
+                          1,
+                          'The property json was not updated exactly once')
+        response_json = json.loads(self.client.get(feature_url).content)['features'][0]
+        self.assertFalse(response_json['properties']['first'],
+                         'The property was not updated')
+        self.assertFalse(response_json['private'],
+                         'The private flag was not updated')
+
+        #an update without changes writes nothing
+        queries = self.get_queries(self.client.put,
+                                   feature_url,
+                                   json.dumps(new_feature),
+                                   content_type = 'application/json')
+        self.assertEquals(self.count_updates(queries, Feature) +
+                          self.count_updates(queries, Property) +
+                          self.count_updates(queries, JSON),
+                          0,
+                          'An update without changes wrote to the database')
+
     def test_create_and_delete_feature(self):
         self.client.login(username = 'user1',
                           password = 'passwd')
@@ -690,6 +785,1239 @@ class GeoRESTTest(TestCase):
                           0,
                           'the feature was not deleted')
 
+    def test_bbox_and_intersects_filter(self):
+        self.client.login(username = 'user1',
+                          password = 'passwd')
+
+        #create two features far from each other
+        new_feature = self.create_feature()
+        response = self.client.post(reverse('feat') + '/@me/area',
+                                    json.dumps(new_feature),
+                                    content_type = 'application/json')
+        inside_id = json.loads(response.content)['id']
+
+        new_feature['geometry']['coordinates'] = [10, 10]
+        response = self.client.post(reverse('feat') + '/@me/area',
+                                    json.dumps(new_feature),
+                                    content_type = 'application/json')
+
+        #query with a bbox around the first feature
+        response = self.client.get(reverse('feat') + '/@me/area?bbox=15,25,25,35')
+        response_json = json.loads(response.content)
+        self.assertEquals([feat['id'] for feat in response_json['features']],
+                          [inside_id],
+                          'Querying with a bbox did not return only the feature inside it')
+
+        #query with a bbox including the srid
+        response = self.client.get(reverse('feat') + '/@me/area?bbox=0,0,25,35,4326')
+        response_json = json.loads(response.content)
+        self.assertEquals(len(response_json['features']),
+                          2,
+                          'Querying with a bbox and srid did not return both features')
+
+        #query with a geojson geometry
+        polygon = {'type': 'Polygon',
+                   'coordinates': [[[5, 5], [15, 5], [15, 15], [5, 15], [5, 5]]]}
+        response = self.client.get(reverse('feat') + '/@me/area',
+                                   {'intersects': json.dumps(polygon)})
+        response_json = json.loads(response.content)
+        self.assertEquals(len(response_json['features']),
+                          1,
+                          'Querying with a geojson geometry did not return one feature')
+        self.assertNotEquals(response_json['features'][0]['id'],
+                             inside_id,
+                             'Querying with a geojson geometry returned the wrong feature')
+
+        #query with a WKT geometry
+        response = self.client.get(reverse('feat') + '/@me/area',
+                                   {'intersects': 'POLYGON ((19 29, 21 29, 21 31, 19 31, 19 29))'})
+        response_json = json.loads(response.content)
+        self.assertEquals([feat['id'] for feat in response_json['features']],
+                          [inside_id],
+                          'Querying with a WKT geometry did not return the feature')
+
+        #invalid parameters should return bad request
+        response = self.client.get(reverse('feat') + '/@me/area?bbox=1,2,3')
+        self.assertEquals(response.status_code,
+                          400,
+                          'An invalid bbox did not return 400')
+        response = self.client.get(reverse('feat') + '/@me/area?bbox=1,2,3,4,999999')
+        self.assertEquals(response.status_code,
+                          400,
+                          'A bbox in an unknown srid did not return 400')
+        response = self.client.get(reverse('feat') + '/@me/area?bbox=1,2,3,4,x')
+        self.assertEquals(response.status_code,
+                          400,
+                          'A bbox with an invalid srid did not return 400')
+        response = self.client.get(reverse('feat') + '/@me/area?intersects=notageometry')
+        self.assertEquals(response.status_code,
+                          400,
+                          'An invalid geometry did not return 400')
+
+    def test_paginate_features(self):
+        self.client.login(username = 'user1',
+                          password = 'passwd')
+
+        new_feature = self.create_feature()
+        feature_ids = []
+        for i in range(3):
+            response = self.client.post(reverse('feat') + '/@me/pages',
+                                        json.dumps(new_feature),
+                                        content_type = 'application/json')
+            feature_ids.append(json.loads(response.content)['id'])
+
+        #the first page should link to the next one
+        response = self.client.get(reverse('feat') + '/@me/pages?limit=2')
+        response_json = json.loads(response.content)
+        self.assertEquals([feat['id'] for feat in response_json['features']],
+                          feature_ids[:2],
+                          'The first page did not contain the first two features')
+        self.assertTrue(response_json.has_key('next'),
+                        'The first page did not have a next link')
+        self.assertTrue(response.has_header('Link'),
+                        'The first page did not have a Link header')
+
+        #the last page should not have a next link
+        response = self.client.get(response_json['next'])
+        response_json = json.loads(response.content)
+        self.assertEquals([feat['id'] for feat in response_json['features']],
+                          feature_ids[2:],
+                          'The second page did not contain the last feature')
+        self.assertFalse(response_json.has_key('next'),
+                         'The last page had a next link')
+
+        #the page size is capped to the server side maximum
+        with self.settings(GEOJSON_REST_MAX_PAGE_SIZE = 1):
+            response = self.client.get(reverse('feat') + '/@me/pages?limit=100')
+        response_json = json.loads(response.content)
+        self.assertEquals(len(response_json['features']),
+                          1,
+                          'The page size was not capped to the maximum')
+
+        #a request without a limit gets the default page size
+        with self.settings(GEOJSON_REST_PAGE_SIZE = 2):
+            response = self.client.get(reverse('feat') + '/@me/pages')
+        response_json = json.loads(response.content)
+        self.assertEquals([feat['id'] for feat in response_json['features']],
+                          feature_ids[:2],
+                          'The default page size was not applied')
+        self.assertTrue(response_json.has_key('next'),
+                        'The default page did not have a next link')
+        with self.settings(GEOJSON_REST_MAX_PAGE_SIZE = 1):
+            response = self.client.get(reverse('feat') + '/@me/pages')
+        self.assertEquals(len(json.loads(response.content)['features']),
+                          1,
+                          'A request without a limit was not capped to the maximum')
+
+        response = self.client.get(reverse('feat') + '/@me/pages?cursor=invalid')
+        self.assertEquals(response.status_code,
+                          400,
+                          'An invalid cursor did not return 400')
+
+    def test_stream_features(self):
+        self.client.login(username = 'user1',
+                          password = 'passwd')
+
+        for i in range(3):
+            new_feature = self.create_feature({'index': i})
+            response = self.client.post(reverse('feat') + '/@me/stream',
+                                        json.dumps(new_feature),
+                                        content_type = 'application/json')
+
+        response = self.client.get(reverse('feat') + '/@me/stream')
+        expected_json = json.loads(response.content)
+
+        #read the streamed collection one row at a time
+        with self.settings(GEOJSON_REST_CHUNK_SIZE = 1):
+            response = self.client.get(reverse('feat') + '/@me/stream?stream=true')
+            self.assertTrue(response.streaming,
+                            'The collection was not streamed')
+            response_json = json.loads(''.join(response.streaming_content))
+
+        self.assertEquals(response_json,
+                          expected_json,
+                          'The streamed collection differs from the normal one')
+        self.assertEquals(len(response_json['features']),
+                          3,
+                          'The streamed collection did not contain all features')
+
+    @override_settings(GEOJSON_REST_CHUNK_SIZE = 5000)
+    def test_get_features_query_count(self):
+        #create a small and a large group with empty json caches
+        for i in range(10):
+            Feature(user = self.user1,
+                    group = 'small').create(self.create_feature({'index': i}))
+        for i in range(1000):
+            Feature(user = self.user1,
+                    group = 'large').create(self.create_feature({'index': i}))
+        Feature.objects.update(json_str = '',
+                               geometry_json = '')
+        Property.objects.update(json_str = '')
+
+        self.client.login(username = 'user1',
+                          password = 'passwd')
+
+        small_queries = self.count_queries(self.client.get,
+                                           reverse('feat') + '/@me/small')
+        large_queries = self.count_queries(self.client.get,
+                                           reverse('feat') + '/@me/large')
+        self.assertEquals(small_queries,
+                          large_queries,
+                          'Getting 1000 features made %i queries while getting 10 made %i' %
+                          (large_queries, small_queries))
+        self.assertEquals(Feature.objects.filter(json_str = '').count() +
+                          Feature.objects.filter(geometry_json = '').count() +
+                          Property.objects.filter(json_str = '').count(),
+                          0,
+                          'The json caches were not filled')
+
+        #the filled caches are returned as they are
+        response = self.client.get(reverse('feat') + '/@me/large')
+        response_json = json.loads(response.content)
+        self.assertEquals(len(response_json['features']),
+                          1000,
+                          'Querying the large group did not return all features')
+        self.assertEquals(sorted([feat['properties']['index']
+                                  for feat in response_json['features']]),
+                          range(1000),
+                          'The features were not serialized with their properties')
+
+    def test_get_transformed_features(self):
+        self.client.login(username = 'user1',
+                          password = 'passwd')
+
+        new_feature = self.create_feature({'first': True})
+        response = self.client.post(reverse('feat') + '/@me/transform',
+                                    json.dumps(new_feature),
+                                    content_type = 'application/json')
+        feature_id = json.loads(response.content)['id']
+
+        response = self.client.get(reverse('feat') + '/@me/transform?srid=3857')
+        response_json = json.loads(response.content)
+        self.assertEquals(response_json['crs']['properties']['code'],
+                          'EPSG:3857',
+                          'The collection did not report the requested srid')
+        x, y = response_json['features'][0]['geometry']['coordinates']
+        self.assertAlmostEqual(x, 2226389.8, 1,
+                               'The geometry was not transformed')
+        self.assertTrue(response_json['features'][0]['properties']['first'],
+                        'The transformed feature did not have its properties')
+        self.assertEquals(FeatureProjection.objects.filter(feature__id = feature_id,
+                                                           srid = 3857).count(),
+                          1,
+                          'The transformed feature was not cached')
+
+        #the updated properties are composed with the cached transformation
+        new_feature['properties'] = {'first': False}
+        response = self.client.put(reverse('feat') + '/@me/transform/' + str(feature_id),
+                                   json.dumps(new_feature),
+                                   content_type = 'application/json')
+        response = self.client.get(reverse('feat') + '/@me/transform?srid=3857')
+        response_json = json.loads(response.content)
+        self.assertFalse(response_json['features'][0]['properties']['first'],
+                         'The cached transformation was not updated')
+
+        response = self.client.get(reverse('feat') + '/@me/transform?srid=999999')
+        self.assertEquals(response.status_code,
+                          400,
+                          'An unknown srid did not return 400')
+
+    def test_conditional_get_after_expiry(self):
+        self.client.login(username = 'user1',
+                          password = 'passwd')
+
+        response = self.client.post(reverse('feat') + '/@me/expiring',
+                                    json.dumps(self.create_feature()),
+                                    content_type = 'application/json')
+        feature = Feature.objects.get(id = json.loads(response.content)['id'])
+        with self.settings(GEOJSON_REST_CACHE_ENABLED = True):
+            featurecache.get_feature_cache().clear()
+            response = self.client.get(reverse('feat') + '/@me/expiring')
+            etag = response['ETag']
+
+            #the feature expires without a write to the group
+            feature.time.expire_time = timezone.now() - timedelta(seconds = 1)
+            feature.time.save()
+
+            response = self.client.get(reverse('feat') + '/@me/expiring',
+                                       HTTP_IF_NONE_MATCH = etag)
+            self.assertEquals(response.status_code,
+                              200,
+                              'The group returned 304 after a feature expired')
+            self.assertEquals(response['X-GeoJSON-Cache'],
+                              'miss',
+                              'The cached collection was used after a feature expired')
+            self.assertEquals(len(json.loads(response.content)['features']),
+                              0,
+                              'The expired feature was returned')
+
+    def test_conditional_get_expiry_queries(self):
+        self.client.login(username = 'user1',
+                          password = 'passwd')
+
+        for i in range(5):
+            self.client.post(reverse('feat') + '/@me/expiry_queries',
+                             json.dumps(self.create_feature({'index': i})),
+                             content_type = 'application/json')
+        etag = self.client.get(reverse('feat') + '/@me/expiry_queries')['ETag']
+
+        #the expiry is one aggregate and no feature is read for a 304
+        timed_table = connection.ops.quote_name(TimeD._meta.db_table)
+        feature_table = connection.ops.quote_name(Feature._meta.db_table)
+        queries = self.get_queries(self.client.get,
+                                   reverse('feat') + '/@me/expiry_queries',
+                                   HTTP_IF_NONE_MATCH = etag)
+        expiry_queries = [sql for sql in queries if timed_table in sql]
+        self.assertEquals(len(expiry_queries),
+                          1,
+                          'The last expiry was queried more than once')
+        self.assertTrue('MAX(' in expiry_queries[0],
+                        'The last expiry was not queried with an aggregate')
+        self.assertEquals([sql for sql in queries if feature_table in sql],
+                          expiry_queries,
+                          'The features were read for a conditional GET')
+
+    def test_create_feature_collection_crs(self):
+        self.client.login(username = 'user1',
+                          password = 'passwd')
+
+        #the crs of the collection applies to features without their own
+        projected_feature = self.create_feature({'index': 0})
+        projected_feature['geometry']['coordinates'] = [2226389.8, 3503549.8]
+        own_crs_feature = self.create_feature({'index': 1})
+        own_crs_feature['crs'] = {'type': 'name',
+                                  'properties': {'name': 'EPSG:4326'}}
+        featurecollection = self.create_feature_collection()
+        featurecollection['crs'] = {'type': 'name',
+                                    'properties': {'name': 'EPSG:3857'}}
+        featurecollection['features'] = [projected_feature, own_crs_feature]
+        response = self.client.post(reverse('feat') + '/@me/collection_crs',
+                                    json.dumps(featurecollection),
+                                    content_type = 'application/json')
+        self.assertEquals(response.status_code,
+                          201,
+                          'Creating the feature collection failed')
+
+        response = self.client.get(reverse('feat') + '/@me/collection_crs')
+        for feature in json.loads(response.content)['features']:
+            x, y = feature['geometry']['coordinates']
+            self.assertAlmostEqual(x, 20, 5,
+                                   'The crs of feature %i was not applied' %
+                                   feature['properties']['index'])
+            self.assertAlmostEqual(y, 30, 5,
+                                   'The crs of feature %i was not applied' %
+                                   feature['properties']['index'])
+
+    def test_conditional_get(self):
+        self.client.login(username = 'user1',
+                          password = 'passwd')
+
+        new_feature = self.create_feature()
+        response = self.client.post(reverse('feat') + '/@me/poll',
+                                    json.dumps(new_feature),
+                                    content_type = 'application/json')
+
+        response = self.client.get(reverse('feat') + '/@me/poll')
+        self.assertTrue(response.has_header('ETag'),
+                        'The response did not have an ETag header')
+        self.assertTrue(response.has_header('Last-Modified'),
+                        'The response did not have a Last-Modified header')
+        etag = response['ETag']
+
+        #nothing has changed in the group
+        response = self.client.get(reverse('feat') + '/@me/poll',
+                                   HTTP_IF_NONE_MATCH = etag)
+        self.assertEquals(response.status_code,
+                          304,
+                          'An unchanged group did not return 304')
+
+        #other query parameters are another representation
+        response = self.client.get(reverse('feat') + '/@me/poll?limit=1',
+                                   HTTP_IF_NONE_MATCH = etag)
+        self.assertEquals(response.status_code,
+                          200,
+                          'Another representation of the group returned 304')
+
+        #a new feature changes the group
+        response = self.client.post(reverse('feat') + '/@me/poll',
+                                    json.dumps(new_feature),
+                                    content_type = 'application/json')
+        response = self.client.get(reverse('feat') + '/@me/poll',
+                                   HTTP_IF_NONE_MATCH = etag)
+        self.assertEquals(response.status_code,
+                          200,
+                          'A changed group returned 304')
+        self.assertNotEquals(response['ETag'],
+                             etag,
+                             'The ETag did not change after creating a feature')
+        self.assertEquals(len(json.loads(response.content)['features']),
+                          2,
+                          'The changed group did not return both features')
+
+        #properties of the group are versioned as well
+        response = self.client.post(reverse('prop') + '/@me/poll/@null',
+                                    json.dumps({'first': 1}),
+                                    content_type = 'application/json')
+        property_id = json.loads(response.content)['id']
+        response = self.client.get('%s/@me/poll/@null/%i' % (reverse('prop'),
+                                                             property_id))
+        etag = response['ETag']
+        response = self.client.get('%s/@me/poll/@null/%i' % (reverse('prop'),
+                                                             property_id),
+                                   HTTP_IF_NONE_MATCH = etag)
+        self.assertEquals(response.status_code,
+                          304,
+                          'An unchanged property did not return 304')
+        response = self.client.put('%s/@me/poll/@null/%i' % (reverse('prop'),
+                                                             property_id),
+                                   json.dumps({'first': 2}),
+                                   content_type = 'application/json')
+        response = self.client.get('%s/@me/poll/@null/%i' % (reverse('prop'),
+                                                             property_id),
+                                   HTTP_IF_NONE_MATCH = etag)
+        self.assertEquals(json.loads(response.content)['first'],
+                          2,
+                          'The updated property was not returned')
+
+    def test_create_feature_collection(self):
+        self.client.login(username = 'user1',
+                          password = 'passwd')
+
+        new_featurecollection = self.create_feature_collection()
+        for i in range(3):
+            new_feature = self.create_feature({'index': i})
+            new_feature['geometry']['coordinates'] = [i, i]
+            new_featurecollection['features'].append(new_feature)
+
+        response = self.client.post(reverse('feat') + '/@me/bulk',
+                                    json.dumps(new_featurecollection),
+                                    content_type = 'application/json')
+        self.assertEquals(response.status_code,
+                          201,
+                          'Creating a feature collection did not return 201 created')
+        response_json = json.loads(response.content)
+        self.assertEquals(len(response_json['features']),
+                          3,
+                          'The created collection did not contain all features')
+        self.assertEquals(len(response_json['uris']),
+                          3,
+                          'The created collection did not contain the uris')
+        self.assertEquals([feat['properties']['index']
+                           for feat in response_json['features']],
+                          [0, 1, 2],
+                          'The created features did not have their properties')
+
+        #the created features can be queried
+        response = self.client.get(response_json['uris'][1])
+        feature_json = json.loads(response.content)['features'][0]
+        self.assertEquals(feature_json,
+                          response_json['features'][1],
+                          'The created feature differs from the queried one')
+        self.assertEquals(feature_json['geometry']['coordinates'],
+                          [1, 1],
+                          'The created feature did not have its geometry')
+
+        #the created properties can be updated
+        new_feature = self.create_feature({'index': 10})
+        response = self.client.put(response_json['uris'][1],
+                                   json.dumps(new_feature),
+                                   content_type = 'application/json')
+        self.assertEquals(json.loads(response.content)['properties']['index'],
+                          10,
+                          'The property of a created feature was not updated')
+
+        response = self.client.post(reverse('feat') + '/@me/bulk',
+                                    json.dumps({'type': 'FeatureCollection'}),
+                                    content_type = 'application/json')
+        self.assertEquals(response.status_code,
+                          400,
+                          'An invalid feature collection did not return 400')
+
+    def test_rebuild_geojson_cache(self):
+        feature = Feature(user = self.user1,
+                          group = 'rebuild')
+        feature.create(self.create_feature({'first': True}))
+        expected_json_str = feature.get_json_str()
+        Feature.objects.filter(id = feature.id).update(json_str = '{"stale": true}')
+
+        #verify only reports the stale cache
+        output = StringIO()
+        call_command('rebuild_geojson_cache',
+                     verify = True,
+                     group = 'rebuild',
+                     stdout = output)
+        self.assertTrue(str(feature.id) in output.getvalue(),
+                        'The stale feature cache was not reported')
+        self.assertEquals(Feature.objects.get(id = feature.id).json_str,
+                          '{"stale": true}',
+                          'Verifying the caches changed them')
+
+        call_command('rebuild_geojson_cache',
+                     group = 'rebuild',
+                     chunk_size = 1,
+                     stdout = StringIO())
+        self.assertEquals(json.loads(Feature.objects.get(id = feature.id).get_json_str()),
+                          json.loads(expected_json_str),
+                          'The stale feature cache was not rebuilt')
+
+    def test_time_filter(self):
+        self.client.login(username = 'user1',
+                          password = 'passwd')
+
+        new_feature = self.create_feature()
+        response = self.client.post(reverse('feat') + '/@me/timed',
+                                    json.dumps(new_feature),
+                                    content_type = 'application/json')
+        feature_id = json.loads(response.content)['id']
+        response = self.client.post(reverse('feat') + '/@me/timed',
+                                    json.dumps(new_feature),
+                                    content_type = 'application/json')
+
+        #let the first feature expire an hour ago
+        now = timezone.now()
+        TimeD.objects.filter(feature__id = feature_id).update(
+            create_time = now - timedelta(hours = 2),
+            expire_time = now - timedelta(hours = 1))
+
+        response = self.client.get(reverse('feat') + '/@me/timed')
+        response_json = json.loads(response.content)
+        self.assertEquals(len(response_json['features']),
+                          1,
+                          'An expired feature was returned by default')
+        self.assertNotEquals(response_json['features'][0]['id'],
+                             feature_id,
+                             'The expired feature was returned by default')
+
+        response = self.client.get(reverse('feat') + '/@me/timed?time=@all')
+        response_json = json.loads(response.content)
+        self.assertEquals(len(response_json['features']),
+                          2,
+                          'Querying @all did not return the expired feature')
+
+        response = self.client.get(reverse('feat') + '/@me/timed',
+                                   {'time': (now - timedelta(minutes = 90)).isoformat()})
+        response_json = json.loads(response.content)
+        self.assertEquals([feat['id'] for feat in response_json['features']],
+                          [feature_id],
+                          'Querying a past time did not return the feature valid then')
+
+        response = self.client.get(reverse('feat') + '/@me/timed?time=yesterday')
+        self.assertEquals(response.status_code,
+                          400,
+                          'An invalid time did not return 400')
+
+    def test_property_filter(self):
+        self.client.login(username = 'user1',
+                          password = 'passwd')
+
+        reports = [{'category': 'noise', 'level': 5, 'place': {'type': 'park'}},
+                   {'category': 'noise', 'level': 2, 'tags': ['night', 'traffic']},
+                   {'category': 'traffic', 'level': 4, 'ok': False}]
+        feature_ids = []
+        for report in reports:
+            response = self.client.post(reverse('feat') + '/@me/reports',
+                                        json.dumps(self.create_feature(report)),
+                                        content_type = 'application/json')
+            feature_ids.append(json.loads(response.content)['id'])
+
+        def query(params):
+            response = self.client.get(reverse('feat') + '/@me/reports', params)
+            return [feat['id'] for feat in json.loads(response.content)['features']]
+
+        self.assertEquals(query({'prop.category': 'noise'}),
+                          feature_ids[:2],
+                          'Filtering with a text value did not work')
+        self.assertEquals(query({'prop.level': '4'}),
+                          feature_ids[2:],
+                          'Filtering with a number value did not work')
+        self.assertEquals(query({'prop.category': 'noise', 'prop.level__gte': '3'}),
+                          feature_ids[:1],
+                          'Filtering with two values did not work')
+        self.assertEquals(query({'prop.category__in': 'traffic,other'}),
+                          feature_ids[2:],
+                          'Filtering with in did not work')
+        self.assertEquals(query({'prop.place.type': 'park'}),
+                          feature_ids[:1],
+                          'Filtering with a nested key did not work')
+        self.assertEquals(query({'prop.tags': 'traffic'}),
+                          feature_ids[1:2],
+                          'Filtering with a list item did not work')
+        self.assertEquals(query({'prop.ok': 'false'}),
+                          feature_ids[2:],
+                          'Filtering with a boolean did not work')
+
+        #updated values are filtered as well
+        response = self.client.put(reverse('feat') + '/@me/reports/' + str(feature_ids[0]),
+                                   json.dumps(self.create_feature({'category': 'other'})),
+                                   content_type = 'application/json')
+        self.assertEquals(query({'prop.category': 'noise'}),
+                          feature_ids[1:2],
+                          'Filtering did not use the updated value')
+
+        response = self.client.get(reverse('feat') + '/@me/reports?prop.level__near=3')
+        self.assertEquals(response.status_code,
+                          400,
+                          'An unknown lookup did not return 400')
+
+    def test_simplified_features(self):
+        self.client.login(username = 'user1',
+                          password = 'passwd')
+
+        #a circle with a lot of vertices
+        circle = Point(20, 30).buffer(1, 64)
+        new_feature = self.create_feature()
+        new_feature['geometry'] = {'type': 'Polygon',
+                                   'coordinates': [list(circle.exterior_ring.coords)]}
+        response = self.client.post(reverse('feat') + '/@me/overview',
+                                    json.dumps(new_feature),
+                                    content_type = 'application/json')
+        feature_id = json.loads(response.content)['id']
+        self.assertTrue(SimplifiedGeometry.objects.filter(feature__id = feature_id).count() > 0,
+                        'The simplified geometries were not created')
+
+        response = self.client.get(reverse('feat') + '/@me/overview')
+        full_ring = json.loads(response.content)['features'][0]['geometry']['coordinates'][0]
+
+        response = self.client.get(reverse('feat') + '/@me/overview?zoom=2')
+        response_json = json.loads(response.content)
+        simple_ring = response_json['features'][0]['geometry']['coordinates'][0]
+        self.assertTrue(len(simple_ring) < len(full_ring),
+                        'Querying with a zoom level did not simplify the geometry')
+        self.assertEquals(response_json['features'][0]['id'],
+                          feature_id,
+                          'The simplified feature did not keep its id')
+
+        #a small tolerance returns the full geometry
+        response = self.client.get(reverse('feat') + '/@me/overview?simplify=0.0000001')
+        ring = json.loads(response.content)['features'][0]['geometry']['coordinates'][0]
+        self.assertEquals(len(ring),
+                          len(full_ring),
+                          'A small tolerance simplified the geometry')
+
+        response = self.client.get(reverse('feat') + '/@me/overview?zoom=far')
+        self.assertEquals(response.status_code,
+                          400,
+                          'An invalid zoom did not return 400')
+
+    def test_feature_tile(self):
+        #a point in the origin is in the middle of the world tile
+        point = Point(0, 0, srid = 3857)
+        self.assertEquals(tile_geometry(point, tile_bounds(0, 0, 0)),
+                          (1, [9, 8192, 8192]),
+                          'The point was not encoded in the middle of the tile')
+        self.assertEquals(tile_geometry(point, tile_bounds(2, 0, 0)),
+                          None,
+                          'A point outside the tile was encoded')
+
+        self.client.login(username = 'user1',
+                          password = 'passwd')
+        new_feature = self.create_feature()
+        self.client.post(reverse('feat') + '/@me/tiled',
+                         json.dumps(new_feature),
+                         content_type = 'application/json')
+
+        tile_url = reverse('feature_tile', kwargs = {'group': 'tiled',
+                                                     'z': '0',
+                                                     'x': '0',
+                                                     'y': '0'})
+        response = self.client.get(tile_url)
+        self.assertEquals(response.status_code,
+                          200,
+                          'Getting a tile did not return 200')
+        self.assertEquals(response['Content-Type'],
+                          'application/vnd.mapbox-vector-tile',
+                          'The tile did not have the vector tile content type')
+        self.assertTrue('tiled' in response.content,
+                        'The tile did not contain the layer of the group')
+        tile = response.content
+
+        #the second request is served from the cache
+        response = self.client.get(tile_url)
+        self.assertEquals(response.content,
+                          tile,
+                          'The cached tile was different')
+
+        #a new feature invalidates the cached tile
+        self.client.post(reverse('feat') + '/@me/tiled',
+                         json.dumps(new_feature),
+                         content_type = 'application/json')
+        response = self.client.get(tile_url)
+        self.assertTrue(len(response.content) > len(tile),
+                        'The tile was not updated with the new feature')
+
+        response = self.client.get(reverse('feature_tile',
+                                           kwargs = {'group': 'tiled',
+                                                     'z': '1',
+                                                     'x': '2',
+                                                     'y': '0'}))
+        self.assertEquals(response.status_code,
+                          404,
+                          'A tile outside the world did not return 404')
+
+        self.client.logout()
+        response = self.client.get(tile_url)
+        self.assertEquals(response.status_code,
+                          401,
+                          'Getting a tile without signing in did not return 401')
+
+    def test_feature_clusters(self):
+        self.client.login(username = 'user1',
+                          password = 'passwd')
+
+        #two features near each other and one far away
+        for coordinates, kind in (([20.1, 30.1], 'tree'),
+                                  ([20.2, 30.2], 'tree'),
+                                  ([-50.5, -20.5], 'bush')):
+            new_feature = self.create_feature({'kind': kind})
+            new_feature['geometry']['coordinates'] = coordinates
+            self.client.post(reverse('feat') + '/@me/clustered',
+                             json.dumps(new_feature),
+                             content_type = 'application/json')
+
+        clusters_url = reverse('feature_clusters', kwargs = {'user': '@me',
+                                                             'group': 'clustered'})
+        response = self.client.get(clusters_url + '?cell=10')
+        self.assertEquals(response.status_code,
+                          200,
+                          'Getting the clusters did not return 200')
+        clusters = json.loads(response.content)['features']
+        self.assertEquals(sorted([cluster['properties']['count']
+                                  for cluster in clusters]),
+                          [1, 2],
+                          'The features were not grouped into the grid cells')
+        for cluster in clusters:
+            if cluster['properties']['count'] == 2:
+                self.assertAlmostEquals(cluster['geometry']['coordinates'][0],
+                                        20.15,
+                                        5,
+                                        'The cluster was not in the centroid of its features')
+                self.assertEquals(cluster['properties']['cell'],
+                                  [20, 30, 30, 40],
+                                  'The cell bounds of the cluster were wrong')
+
+        response = self.client.get(clusters_url + '?cell=10&bbox=0,0,50,50')
+        self.assertEquals([cluster['properties']['count']
+                           for cluster in json.loads(response.content)['features']],
+                          [2],
+                          'The clusters were not limited to the bbox')
+
+        response = self.client.get(clusters_url + '?zoom=0&prop.kind=bush')
+        self.assertEquals([cluster['properties']['count']
+                           for cluster in json.loads(response.content)['features']],
+                          [1],
+                          'The clusters were not limited by the property filter')
+
+        response = self.client.get(clusters_url)
+        self.assertEquals(response.status_code,
+                          400,
+                          'Clustering without a cell size did not return 400')
+
+    def test_geometry_codec(self):
+        polygon = {'type': 'Polygon',
+                   'coordinates': [[[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]],
+                                   [[2, 2], [2, 4], [4, 4], [2, 2]]]}
+        geometries = [
+            {'type': 'Point', 'coordinates': [20, 30]},
+            {'type': 'Point', 'coordinates': [20, 30, 5]},
+            {'type': 'LineString', 'coordinates': [[102.0, 0.0], [103.0, 1.0]]},
+            polygon,
+            {'type': 'MultiPoint', 'coordinates': [[1, 2], [3, 4]]},
+            {'type': 'MultiLineString', 'coordinates': [[[1, 2], [3, 4]]]},
+            {'type': 'MultiPolygon', 'coordinates': [polygon['coordinates']]},
+            {'type': 'GeometryCollection', 'geometries': [polygon]}
+        ]
+        for geometry in geometries:
+            geos_geometry = from_geojson(geometry, 4326)
+            self.assertEquals(geos_geometry.geom_type,
+                              geometry['type'],
+                              'The geometry type changed in the conversion')
+            self.assertEquals(geos_geometry.srid,
+                              4326,
+                              'The srid was not set to the geometry')
+            self.assertTrue(geos_geometry.equals(GEOSGeometry(to_wkt(geometry))),
+                            'The geometry and its WKT were different')
+
+        self.assertEquals(to_wkt(geometries[0]),
+                          'POINT (20.0000000000000000 30.0000000000000000)',
+                          'The WKT of a point was not written in 16 decimals')
+        self.assertEquals(from_geojson(geometries[1]).z,
+                          5,
+                          'The z coordinate was lost in the conversion')
+
+        for invalid in ({'type': 'Circle', 'coordinates': [1, 2]},
+                        {'type': 'Point', 'coordinates': ['a', 'b']},
+                        {'type': 'LineString', 'coordinates': [[1, 2], [3]]},
+                        {'type': 'Polygon', 'coordinates': [[[1, 2], [3, 4]]]}):
+            self.assertRaises(ValueError, from_geojson, invalid)
+
+    def test_get_srid(self):
+        for name, srid in (('EPSG:3067', 3067),
+                           ('urn:ogc:def:crs:EPSG::3857', 3857),
+                           ('urn:ogc:def:crs:EPSG:6.6:4326', 4326),
+                           ('urn:ogc:def:crs:OGC:1.3:CRS84', 4326)):
+            self.assertEquals(get_srid({'crs': {'type': 'name',
+                                                'properties': {'name': name}}}),
+                              srid,
+                              'The srid of %s was not read' % name)
+        self.assertEquals(get_srid({'type': 'Point'}), None)
+        self.assertEquals(get_srid({'crs': None}), None)
+        for name in ('EPSG:', 'EPSG', 'urn:ogc:def:crs:EPSG::x', 'unknown:4326'):
+            self.assertRaises(ValueError,
+                              get_srid,
+                              {'crs': {'type': 'name',
+                                       'properties': {'name': name}}})
+
+        #a malformed crs is a bad request
+        self.client.login(username = 'user1',
+                          password = 'passwd')
+        new_feature = self.create_feature()
+        new_feature['crs'] = {'type': 'name',
+                              'properties': {'name': 'EPSG:'}}
+        response = self.client.post(reverse('feat'),
+                                    json.dumps(new_feature),
+                                    content_type = 'application/json')
+        self.assertEquals(response.status_code,
+                          400,
+                          'A feature with a malformed crs did not return 400')
+
+        self.assertEquals(json.loads(to_geojson(GEOSGeometry('POINT EMPTY'))),
+                          {'type': 'Point', 'coordinates': []},
+                          'The empty point was not written as geojson')
+
+    def test_feature_json_str(self):
+        self.client.login(username = 'user1',
+                          password = 'passwd')
+
+        new_feature = self.create_feature({'some_prop': 'some value'})
+        new_feature['geometry'] = {'type': 'Polygon',
+                                   'coordinates': [[[20.123456, 30.987654],
+                                                    [21, 30],
+                                                    [21, 31],
+                                                    [20.123456, 30.987654]]]}
+        response = self.client.post(reverse('feat'),
+                                    json.dumps(new_feature),
+                                    content_type = 'application/json')
+        feature = Feature.objects.get(id = json.loads(response.content)['id'])
+        self.assertEquals(json.loads(feature.to_json_str()),
+                          json.loads(json.dumps(feature.to_json())),
+                          'The json string and the json of the feature were different')
+        self.assertEquals(json.loads(feature.get_json_str())['geometry'],
+                          new_feature['geometry'],
+                          'The geometry was changed in the json string')
+
+        with override_settings(GEOJSON_REST_COORDINATE_PRECISION = 2):
+            self.assertEquals(json.loads(feature.to_json_str())['geometry']['coordinates'][0][0],
+                              [20.12, 30.99],
+                              'The coordinates were not rounded to the precision')
+
+    def test_json_backend(self):
+        obj = {'type': 'Feature',
+               'properties': {'name': u'\xe4\xf6', 'url': 'http://a/b', 'value': 0.1,
+                              'sum': 0.1 + 0.2},
+               'geometry': {'type': 'Point', 'coordinates': [20.123456789012, 30]}}
+        self.assertEquals(jsonbackend.loads(jsonbackend.dumps(obj)),
+                          obj,
+                          'The default json backend changed the object')
+
+        with override_settings(GEOJSON_REST_JSON_BACKEND = 'json'):
+            self.assertEquals(jsonbackend.dumps(obj),
+                              json.dumps(obj),
+                              'The json backend did not write the same json as simplejson')
+
+        with override_settings(GEOJSON_REST_JSON_BACKEND = 'yaml'):
+            self.assertRaises(ImproperlyConfigured, jsonbackend.dumps, obj)
+
+    def test_json_backend_old_ujson(self):
+        class OldUltraJSON(object):
+            # a ujson without any of the keyword arguments
+            __name__ = 'ujson'
+
+            def dumps(self, obj):
+                return json.dumps(obj, separators = (',', ':'))
+
+            def loads(self, json_str):
+                return json.loads(json_str)
+
+        backend = jsonbackend.UltraJSONBackend(OldUltraJSON())
+        self.assertEquals(backend.loads(backend.dumps({'url': 'http://a/b'})),
+                          {'url': 'http://a/b'},
+                          'The backend passed arguments the ujson does not have')
+
+        #a library that fails to load is skipped by the automatic choice
+        def load_backend(name):
+            if name == 'ujson':
+                raise TypeError('unexpected keyword argument')
+            return original_load_backend(name)
+
+        original_load_backend = jsonbackend.load_backend
+        jsonbackend.load_backend = load_backend
+        jsonbackend._backends.clear()
+        try:
+            self.assertNotEquals(jsonbackend.get_backend().name,
+                                 'ujson',
+                                 'A ujson that could not be loaded was used')
+        finally:
+            jsonbackend.load_backend = original_load_backend
+            jsonbackend._backends.clear()
+
+    def test_post_property_to_feature(self):
+        self.client.login(username = 'user1',
+                          password = 'passwd')
+        response = self.client.post(reverse('feat') + '/@me/added',
+                                    json.dumps(self.create_feature()),
+                                    content_type = 'application/json')
+        feature_id = json.loads(response.content)['id']
+
+        #the version of the group is bumped after the property is added
+        through_table = connection.ops.quote_name(Feature.properties.through._meta.db_table)
+        version_table = connection.ops.quote_name(GroupVersion._meta.db_table)
+        queries = self.get_queries(self.client.post,
+                                   reverse('prop') + '/@me/added/' + str(feature_id),
+                                   json.dumps({'added': True}),
+                                   content_type = 'application/json')
+        add_index = min([i for i, sql in enumerate(queries)
+                         if sql.startswith('INSERT') and through_table in sql])
+        version_indexes = [i for i, sql in enumerate(queries)
+                           if sql.startswith('UPDATE') and version_table in sql]
+        self.assertTrue(max(version_indexes) > add_index,
+                        'The group version was not bumped after the property was added')
+
+        with self.settings(GEOJSON_REST_CACHE_ENABLED = True):
+            featurecache.get_feature_cache().clear()
+            response = self.client.get(reverse('feat') + '/@me/added')
+        self.assertEquals([feature['properties'].get('added')
+                           for feature in json.loads(response.content)['features']],
+                          [True],
+                          'The added property was not in the collection')
+
+    def test_shared_property_refresh(self):
+        self.client.login(username = 'user1',
+                          password = 'passwd')
+
+        response = self.client.post(reverse('prop'),
+                                    json.dumps({'shared': 1}),
+                                    content_type = 'application/json')
+        shared = Property.objects.get(id = json.loads(response.content)['id'])
+        property_url = reverse('prop') + '/@me/@self/@null/' + str(shared.id)
+
+        def add_features(count):
+            for i in range(count):
+                response = self.client.post(reverse('feat'),
+                                            json.dumps(self.create_feature({'own': i})),
+                                            content_type = 'application/json')
+                feature = Feature.objects.get(id = json.loads(response.content)['id'])
+                feature.properties.add(shared)
+
+        def put_property(value):
+            self.client.put(property_url,
+                            json.dumps({'shared': value}),
+                            content_type = 'application/json')
+
+        #the number of queries does not depend on the number of features
+        add_features(2)
+        few_queries = self.count_queries(put_property, 2)
+        add_features(20)
+        many_queries = self.count_queries(put_property, 3)
+        self.assertEquals(few_queries,
+                          many_queries,
+                          'The number of queries grew with the number of features')
+        response = self.client.get(reverse('feat') + '/@me/@self')
+        for feature in json.loads(response.content)['features']:
+            self.assertEquals(feature['properties']['shared'],
+                              3,
+                              'The feature was not updated with the shared property')
+
+        #only the fragment of the property is written
+        queries = self.get_queries(put_property, 4)
+        self.assertEquals(self.count_updates(queries, Feature),
+                          0,
+                          'Updating a property rewrote the features')
+        self.assertEquals(self.count_updates(queries, Property),
+                          1,
+                          'The property fragment was not updated once')
+
+        self.client.delete(property_url)
+        for feature in Feature.objects.all():
+            self.assertFalse('shared' in json.loads(feature.get_json_str())['properties'],
+                             'The deleted property was left in the feature')
+
+    @override_settings(GEOJSON_REST_CACHE_ENABLED = True)
+    def test_feature_cache(self):
+        featurecache.get_feature_cache().clear()
+        self.client.login(username = 'user1',
+                          password = 'passwd')
+
+        self.client.post(reverse('feat') + '/@me/cached',
+                         json.dumps(self.create_feature()),
+                         content_type = 'application/json')
+
+        response = self.client.get(reverse('feat') + '/@me/cached')
+        self.assertEquals(response['X-GeoJSON-Cache'],
+                          'miss',
+                          'The first request was not a cache miss')
+        self.assertEquals(len(json.loads(response.content)['features']),
+                          1,
+                          'The first request did not return the feature')
+
+        queries = self.count_queries(self.client.get,
+                                     reverse('feat') + '/@me/cached')
+        response = self.client.get(reverse('feat') + '/@me/cached')
+        self.assertEquals(response['X-GeoJSON-Cache'],
+                          'hit',
+                          'The second request was not served from the cache')
+        self.assertTrue(queries <= 3,
+                        'The cached collection made %i queries' % queries)
+
+        #a write to the group changes the key of the collection
+        self.client.post(reverse('feat') + '/@me/cached',
+                         json.dumps(self.create_feature()),
+                         content_type = 'application/json')
+        response = self.client.get(reverse('feat') + '/@me/cached')
+        self.assertEquals(response['X-GeoJSON-Cache'],
+                          'miss',
+                          'The cached collection was used after a write')
+        self.assertEquals(len(json.loads(response.content)['features']),
+                          2,
+                          'The new feature was not returned')
+
+        #another user has an own cached collection
+        self.client.logout()
+        self.client.login(username = 'user2',
+                          password = 'passwd')
+        response = self.client.get(reverse('feat') + '/@me/cached')
+        self.assertEquals(len(json.loads(response.content)['features']),
+                          0,
+                          'The collection of another user was returned')
+
+        stats = featurecache.get_stats()
+        self.assertEquals((stats['hits'], stats['misses']),
+                          (2, 3),
+                          'The statistics did not count the hits and misses')
+        output = StringIO()
+        call_command('geojson_cache_stats', reset = True, stdout = output)
+        self.assertTrue('hits: 2, misses: 3' in output.getvalue(),
+                        'The statistics were not reported')
+        self.assertEquals(featurecache.get_stats()['hits'],
+                          0,
+                          'The statistics were not reset')
+
+    def test_feature_cache_keys(self):
+        featurecache.get_feature_cache().clear()
+        self.client.login(username = 'user1',
+                          password = 'passwd')
+        feature_ids = []
+        for i in range(2):
+            response = self.client.post(reverse('feat') + '/@me/cache_keys',
+                                        json.dumps(self.create_feature({'index': i})),
+                                        content_type = 'application/json')
+            feature_ids.append(json.loads(response.content)['id'])
+
+        with self.settings(GEOJSON_REST_CACHE_ENABLED = True,
+                           ALLOWED_HOSTS = ['*']):
+            #the absolute next links are cached for each host
+            url = reverse('feat') + '/@me/cache_keys?limit=1'
+            self.client.get(url, HTTP_HOST = 'first.example.com')
+            response = self.client.get(url, HTTP_HOST = 'second.example.com')
+            self.assertEquals(response['X-GeoJSON-Cache'],
+                              'miss',
+                              'The collection cached for another host was used')
+            self.assertTrue(json.loads(response.content)['next'].startswith('http://second.example.com/'),
+                            'The next link pointed to another host')
+
+            #a single feature is cached like a collection of one
+            url = '%s/@me/cache_keys/%i' % (reverse('feat'), feature_ids[0])
+            self.client.get(url)
+            response = self.client.get(url)
+            self.assertEquals(response['X-GeoJSON-Cache'],
+                              'hit',
+                              'The single feature was not served from the cache')
+            self.assertEquals([feat['id'] for feat in json.loads(response.content)['features']],
+                              feature_ids[:1],
+                              'The cached single feature was wrong')
+
+    def test_feature_cache_waiters(self):
+        cache = featurecache.get_feature_cache()
+        cache.clear()
+
+        #the value appears while waiting for the lock
+        cache.add('waited:lock', 1, 30)
+        timer = threading.Timer(0.1, lambda: cache.set('waited', 'value'))
+        timer.start()
+        try:
+            result = featurecache.get_or_build('waited', lambda: 'built')
+        finally:
+            timer.join()
+        self.assertEquals(result,
+                          ('value', 'hit'),
+                          'The waiter did not get the value of the lock holder')
+        stats = featurecache.get_stats()
+        self.assertEquals((stats['hits'], stats['misses'], stats['waits']),
+                          (1, 0, 1),
+                          'A waiter that got the value was not counted as a hit only')
+
+        #the lock expires without a value
+        featurecache.reset_stats()
+        cache.add('abandoned:lock', 1, 30)
+        with self.settings(GEOJSON_REST_CACHE_LOCK_TIMEOUT = 0.1):
+            result = featurecache.get_or_build('abandoned', lambda: 'built')
+        self.assertEquals(result,
+                          ('built', 'miss'),
+                          'The waiter did not build the value')
+        stats = featurecache.get_stats()
+        self.assertEquals((stats['hits'], stats['misses'], stats['waits']),
+                          (0, 1, 1),
+                          'A waiter that built the value was not counted as a miss only')
+
+    def test_featurecount(self):
+        count_url = reverse('featurecount', kwargs = {'data_group': 'counted'})
+
+        self.client.login(username = 'user1',
+                          password = 'passwd')
+        public_feature = self.create_feature()
+        public_feature['private'] = False
+        feature_ids = []
+        for new_feature in (self.create_feature(), self.create_feature(), public_feature):
+            response = self.client.post(reverse('feat') + '/@me/counted',
+                                        json.dumps(new_feature),
+                                        content_type = 'application/json')
+            feature_ids.append(json.loads(response.content)['id'])
+        self.client.logout()
+
+        self.client.login(username = 'user2',
+                          password = 'passwd')
+        featurecollection = self.create_feature_collection()
+        featurecollection['features'] = [self.create_feature(), public_feature]
+        self.client.post(reverse('feat') + '/@me/counted',
+                         json.dumps(featurecollection),
+                         content_type = 'application/json')
+        self.client.logout()
+
+        #the count is read from the counters without counting the features
+        queries = self.get_queries(self.client.get, count_url)
+        self.assertFalse([sql for sql in queries
+                          if '"%s"' % Feature._meta.db_table in sql],
+                         'The features were counted')
+        self.assertEquals(self.client.get(count_url).content, '5')
+        self.assertEquals(self.client.get(count_url, {'private': 'false'}).content, '2')
+        self.assertEquals(self.client.get(count_url, {'private': 'true'}).content, '3')
+        self.assertEquals(self.client.get(count_url, {'user': 'user1'}).content, '3')
+        self.assertEquals(self.client.get(count_url, {'user': 'user2',
+                                                      'private': 'false'}).content, '1')
+        self.assertEquals(self.client.get(count_url, {'user': 'user3'}).content, '0')
+        self.assertEquals(self.client.get(count_url, {'private': 'maybe'}).status_code,
+                          400)
+
+        #updating the private flag and deleting move the counters
+        self.client.login(username = 'user1',
+                          password = 'passwd')
+        self.client.put(reverse('feat') + '/@me/counted/' + str(feature_ids[0]),
+                        json.dumps(public_feature),
+                        content_type = 'application/json')
+        self.client.delete(reverse('feat') + '/@me/counted/' + str(feature_ids[1]))
+        self.assertEquals(self.client.get(count_url).content, '4')
+        self.assertEquals(self.client.get(count_url, {'private': 'false'}).content, '3')
+        self.assertEquals(self.client.get(count_url, {'user': 'user1',
+                                                      'private': 'true'}).content, '0')
+
+        #the reconcile command recomputes the counters from the features
+        FeatureCounter.objects.filter(group = 'counted').update(count = 100)
+        output = StringIO()
+        call_command('reconcile_feature_counts', stdout = output)
+        self.assertTrue(output.getvalue().startswith('7 '),
+                        'The wrong counters were not reported')
+        self.assertEquals(self.client.get(count_url).content, '4')
+        self.assertEquals(self.client.get(count_url, {'user': 'user2'}).content, '2')
+
+    def test_geojsonseq(self):
+        self.client.login(username = 'user1',
+                          password = 'passwd')
+
+        for i in range(3):
+            self.client.post(reverse('feat') + '/@me/seq',
+                             json.dumps(self.create_feature({'text': 'line\n%i' % i})),
+                             content_type = 'application/json')
+        expected_features = json.loads(self.client.get(reverse('feat') + '/@me/seq').content)['features']
+
+        #one feature on each line after a record separator
+        with self.settings(GEOJSON_REST_CHUNK_SIZE = 2):
+            response = self.client.get(reverse('feat') + '/@me/seq?format=geojsonseq')
+            self.assertTrue(response.streaming,
+                            'The sequence was not streamed')
+            content = ''.join(response.streaming_content)
+        self.assertEquals(response['Content-Type'],
+                          'application/geo+json-seq')
+        lines = content.split('\n')
+        self.assertEquals(lines[-1],
+                          '',
+                          'The last feature was not followed by a newline')
+        self.assertTrue(all([line.startswith('\x1e') for line in lines[:-1]]),
+                        'A line did not start with a record separator')
+        self.assertEquals([json.loads(line[1:]) for line in lines[:-1]],
+                          expected_features,
+                          'The sequence differs from the feature collection')
+
+        #the pages of a sequence are linked like the collections
+        response = self.client.get(reverse('feat') + '/@me/seq?format=geojsonseq&limit=2')
+        self.assertEquals(''.join(response.streaming_content).count('\x1e'),
+                          2,
+                          'The sequence was not paged')
+        self.assertTrue('Link' in response,
+                        'The sequence has no link to the next page')
+
+        #the admin action writes the same sequence
+        action_response = download_geojsonseq(FeatureAdmin(Feature, 1),
+                                              "",
+                                              Feature.objects.filter(group = 'seq'))
+        self.assertEquals(''.join(action_response.streaming_content),
+                          content,
+                          'The admin action wrote a different sequence')
+
+    def test_featurecount_duplicate_counters(self):
+        count_url = reverse('featurecount', kwargs = {'data_group': 'duplicated'})
+        Feature(user = self.user1,
+                group = 'duplicated').create(self.create_feature())
+
+        #a concurrent first write could have created a second row
+        FeatureCounter.objects.create(group = 'duplicated',
+                                      user = None,
+                                      private = None,
+                                      count = 0)
+        self.assertEquals(self.client.get(count_url).content, '1')
+
+        feature = Feature(user = self.user1,
+                          group = 'duplicated')
+        feature.create(self.create_feature())
+        self.assertEquals(self.client.get(count_url).content,
+                          '2',
+                          'A create was added to both counter rows')
+
+        feature.delete()
+        self.assertEquals(self.client.get(count_url).content,
+                          '1',
+                          'A delete was subtracted from both counter rows')
+
+    def test_featurecount_lock_order(self):
+        counter_table = connection.ops.quote_name(FeatureCounter._meta.db_table)
+        version_table = connection.ops.quote_name(GroupVersion._meta.db_table)
+
+        def first_write(queries, table):
+            return min([i for i, sql in enumerate(queries)
+                        if table in sql and (sql.startswith('UPDATE') or
+                                             sql.startswith('INSERT'))])
+
+        #the counter is always written before the version of the group
+        feature = Feature(user = self.user1,
+                          group = 'locked')
+        for func, args in ((feature.create, [self.create_feature()]),
+                           (feature.create, [self.create_feature()]),
+                           (feature.update, [dict(self.create_feature(), private = False),
+                                             self.user1]),
+                           (feature.delete, [])):
+            queries = self.get_queries(func, *args)
+            self.assertTrue(first_write(queries, counter_table) <
+                            first_write(queries, version_table),
+                            'The version was locked before the counter in %s' % func.__name__)
+
     def test_create_and_get_property(self):
         #login to the service
         self.client.login(username = 'user1',
@@ -910,13 +2238,108 @@ class GeoRESTTest(TestCase):
                           str(feat3_prop_id),
                           'test2',
                           ''])
-        csvr = csv.reader(csv_response)
-        for index,line in enumerate(csvr):
-            #First line is empty
-            if index > 0:
-                #We need to skip time
-                self.assertEqual(csv_lines[index-1], line, 'csv line:%s is not correct\n %s != %s' % (index, csv_lines[index-1], line) )
+        csvr = csv.reader(StringIO(''.join(csv_response.streaming_content)))
+        lines = list(csvr)
+        self.assertEqual(len(csv_lines), len(lines), 'the csv does not have all the lines')
+        #the order of the columns comes from the schema registry
+        self.assertEqual(sorted(csv_lines[0]), sorted(lines[0]), 'the csv header is not correct')
+        for index in range(1, len(lines)):
+            expected = dict(zip(csv_lines[0], csv_lines[index]))
+            line = dict(zip(lines[0], lines[index]))
+            self.assertEqual(expected, line, 'csv line:%s is not correct\n %s != %s' % (index, expected, line) )
+
+
+    def test_download_csv_streaming(self):
+        for i in range(3):
+            Feature(user = self.user1,
+                    group = 'csv').create(self.create_feature({'index': i}))
+        features = Feature.objects.filter(group = 'csv')
+
+        f_admin = FeatureAdmin(Feature, 1)
+        expected_csv = ''.join(download_csv(f_admin, "", features).streaming_content)
+
+        #the rows are written one chunk at a time
+        with self.settings(GEOJSON_REST_CHUNK_SIZE = 1):
+            csv_response = download_csv(f_admin, "", features)
+            self.assertTrue(csv_response.streaming,
+                            'The csv was not streamed')
+            csv_chunks = list(csv_response.streaming_content)
+
+        self.assertEquals(len(csv_chunks),
+                          4,
+                          'The csv was not written in chunks')
+        self.assertEquals(''.join(csv_chunks),
+                          expected_csv,
+                          'The csv written in chunks differs')
+        self.assertEquals(len(list(csv.reader(StringIO(expected_csv)))),
+                          4,
+                          'The csv does not have a header and a row per feature')
+
+        #the number of queries does not depend on the number of rows
+        small_queries = self.count_queries(
+            lambda: ''.join(download_csv(f_admin, "", features).streaming_content))
+        for i in range(10):
+            Feature(user = self.user1,
+                    group = 'csv').create(self.create_feature({'index': i}))
+        large_queries = self.count_queries(
+            lambda: ''.join(download_csv(f_admin, "", features).streaming_content))
+        self.assertEquals(small_queries,
+                          large_queries,
+                          'Exporting 13 features made %i queries while 3 made %i' %
+                          (large_queries, small_queries))
+
+    def test_property_schema(self):
+        self.client.login(username = 'user1',
+                          password = 'passwd')
 
+        response = self.client.post(reverse('feat') + '/@me/schema',
+                                    json.dumps(self.create_feature({'name': 'a',
+                                                                    'answers': {'q1': 1}})),
+                                    content_type = 'application/json')
+        feature_id = json.loads(response.content)['id']
+        featurecollection = self.create_feature_collection()
+        featurecollection['features'] = [self.create_feature({'name': None}),
+                                         self.create_feature({'tags': ['x', 'y']})]
+        self.client.post(reverse('feat') + '/@me/schema',
+                         json.dumps(featurecollection),
+                         content_type = 'application/json')
+        self.client.put(reverse('feat') + '/@me/schema/' + str(feature_id),
+                        json.dumps(self.create_feature({'visited': True})),
+                        content_type = 'application/json')
+
+        #the keys and types of all the writes are registered
+        self.assertEquals(set(PropertySchemaKey.objects.filter(group = 'schema').values_list('key',
+                                                                                            'value_type')),
+                          set([(u'name', u'string'),
+                               (u'name', u'null'),
+                               (u'answers.q1', u'number'),
+                               (u'tags', u'array'),
+                               (u'visited', u'boolean')]),
+                          'The property schema was not registered')
+
+        #the header is written from the registry before the features are read
+        csv_response = download_csv(FeatureAdmin(Feature, 1),
+                                    "",
+                                    Feature.objects.filter(group = 'schema'))
+        csv_chunks = iter(csv_response.streaming_content)
+        header = next(csv.reader(StringIO(next(csv_chunks))))
+        for column in ('wkt',
+                       'properties.name',
+                       'properties.answers.q1',
+                       'properties.tags',
+                       'properties.visited'):
+            self.assertTrue(column in header,
+                            'The column %s is missing from the header' % column)
+        self.assertEquals(len(header),
+                          len(set(header)),
+                          'The header has duplicate columns')
+        rows = list(csv.DictReader(StringIO(''.join(csv_chunks)), fieldnames = header))
+        self.assertEquals(len(rows),
+                          3,
+                          'The csv does not have a row for each feature')
+        self.assertEquals([row['properties.answers.q1'] for row in rows],
+                          ['1', '', ''],
+                          'The nested property was not written')
 
     def test_download_csv_with_utf_8(self):
         feat1 = self.create_feature({u'first': u'äÄöÖåÅ€'})
@@ -1006,12 +2429,15 @@ class GeoRESTTest(TestCase):
                           'Test',
                           ])
 
-        csvr = csv.reader(csv_response)
-        for index,line in enumerate(csvr):
-            #First line is empty
-            if index > 0:
-                #We need to skip time
-                self.assertEqual(csv_lines[index-1], line, 'csv line:%s is not correct\n %s != %s' % (index, csv_lines[index-1], line) )
+        csvr = csv.reader(StringIO(''.join(csv_response.streaming_content)))
+        lines = list(csvr)
+        self.assertEqual(len(csv_lines), len(lines), 'the csv does not have all the lines')
+        #the order of the columns comes from the schema registry
+        self.assertEqual(sorted(csv_lines[0]), sorted(lines[0]), 'the csv header is not correct')
+        for index in range(1, len(lines)):
+            expected = dict(zip(csv_lines[0], csv_lines[index]))
+            line = dict(zip(lines[0], lines[index]))
+            self.assertEqual(expected, line, 'csv line:%s is not correct\n %s != %s' % (index, expected, line) )
 
 
 class GeoRESTAdminTest(TestCase):
@@ -1181,3 +2607,93 @@ class GeoRESTAdminTest(TestCase):
                           404,
                           'Querying a deleted property did not return not found')
 
+    def test_export_jobs(self):
+        for i in range(3):
+            Feature(user = self.user1,
+                    group = 'export').create(self.create_feature({'index': i}))
+        Feature(user = self.user1,
+                group = 'other').create(self.create_feature())
+
+        export_root = tempfile.mkdtemp()
+        try:
+            with self.settings(GEOJSON_REST_EXPORT_ROOT = export_root,
+                               GEOJSON_REST_CHUNK_SIZE = 2):
+                csv_job = ExportJob.objects.create(group = 'export',
+                                                   format = 'csv')
+                seq_job = ExportJob.objects.create(group = 'export',
+                                                   format = 'geojsonseq')
+                collection_job = ExportJob.objects.create(group = 'export',
+                                                          format = 'geojson')
+
+                #a job is claimed by one worker only
+                claimed = ExportJob.claim('worker1')
+                self.assertEquals(claimed.id,
+                                  csv_job.id,
+                                  'The oldest job was not claimed first')
+                self.assertEquals(ExportJob.claim('worker2').id,
+                                  seq_job.id,
+                                  'A claimed job was claimed again')
+                ExportJob.objects.filter(id__in = [csv_job.id,
+                                                   seq_job.id]).update(status = 'pending')
+
+                call_command('run_export_jobs', once = True, stdout = StringIO())
+
+            for job in ExportJob.objects.all():
+                self.assertEquals((job.status, job.rows, job.total_rows),
+                                  ('done', 3, 3),
+                                  'The %s export did not finish: %s' % (job.format,
+                                                                        job.error))
+            self.assertEquals(ExportJob.claim('worker1'),
+                              None,
+                              'A finished job was claimed')
+
+            csv_job = ExportJob.objects.get(id = csv_job.id)
+            csv_lines = list(csv.reader(gzip.open(csv_job.file_path)))
+            self.assertEquals(len(csv_lines),
+                              4,
+                              'The csv export does not have a header and three rows')
+            seq_lines = gzip.open(ExportJob.objects.get(id = seq_job.id).file_path).read().split('\n')
+            self.assertEquals(len(seq_lines),
+                              4,
+                              'The sequence export does not have three features')
+            collection_job = ExportJob.objects.get(id = collection_job.id)
+            collection = json.loads(gzip.open(collection_job.file_path).read())
+            self.assertEquals(sorted([feature['properties']['index']
+                                      for feature in collection['features']]),
+                              [0, 1, 2],
+                              'The collection export does not have the features of the group')
+
+            #the admin downloads the compressed file
+            self.client.login(username = 'admin', password = 'passwd')
+            response = self.client.get(reverse('admin:geojson_rest_exportjob_download',
+                                               args = (csv_job.id,)))
+            self.assertEquals(''.join(response.streaming_content),
+                              open(csv_job.file_path, 'rb').read(),
+                              'The admin did not download the export')
+            ExportJob.objects.filter(id = csv_job.id).update(status = 'running')
+            response = self.client.get(reverse('admin:geojson_rest_exportjob_download',
+                                               args = (csv_job.id,)))
+            self.assertEquals(response.status_code,
+                              404,
+                              'An unfinished export was downloaded')
+
+            #the files are named by the job only
+            self.assertEquals(os.path.basename(csv_job.file_path),
+                              'export_%i.csv.gz' % csv_job.id)
+
+            #only failed and stalled jobs are run again
+            failed_job = ExportJob.objects.create(group = 'export',
+                                                  status = 'failed')
+            stalled_job = ExportJob.objects.create(group = 'export',
+                                                   status = 'running',
+                                                   updated = timezone.now() - timedelta(days = 1))
+            ExportJob.objects.filter(id = seq_job.id).update(status = 'running',
+                                                             updated = timezone.now())
+            response = self.client.post(reverse('admin:geojson_rest_exportjob_changelist'),
+                                        {'action': 'requeue',
+                                         '_selected_action': [job.id for job in ExportJob.objects.all()]})
+            self.assertEquals(set(ExportJob.objects.filter(status = 'pending').values_list('id', flat = True)),
+                              set([failed_job.id, stalled_job.id]),
+                              'The requeued jobs were not the failed and stalled ones')
+        finally:
+            shutil.rmtree(export_root)
@@ -10,6 +10,14 @@ urlpatterns = patterns('geojson_rest.views',
         name="featurecount"),
 
 
+    url(r'^feat/tiles/(?P<group>@?[-+_\w]+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.mvt$',
+        'feature_tile',
+        name="feature_tile"),
+
+    url(r'^feat/clusters/(?P<user>@?[-+_\w\.]+)/(?P<group>@?[-+_\w]+)$',
+        'feature_clusters',
+        name="feature_clusters"),
+
     url(r'^feat$',
         FeatureView.as_view(),
         {'user': '@me',
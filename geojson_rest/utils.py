@@ -1,5 +1,7 @@
+import math
 from django.core.mail import EmailMessage
 from django.conf import settings
+from geojson_rest import jsonbackend as json
 
 def send_error_mail(request,msg):
     msg += '\n\nrequest.user: ' + str(request.user)
@@ -8,3 +10,97 @@ def send_error_mail(request,msg):
     mail = EmailMessage(title, msg, to=[getattr(settings,'ADMINS',(('master','webmaster@mapita.fi'),))[0][1]])
     mail.send()
 
+def flatten_json(obj, prefix = ''):
+    """
+    This function yields (key, value) pairs of all the scalar
+    values in a json object. The keys of nested objects are
+    joined with dots and the items of a list get the key of
+    the list.
+    """
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if prefix:
+                key = u'%s.%s' % (prefix, key)
+            for item in flatten_json(value, key):
+                yield item
+    elif isinstance(obj, list):
+        for value in obj:
+            for item in flatten_json(value, prefix):
+                yield item
+    else:
+        yield (prefix, obj)
+
+def feature_collection_chunks(featurecollection, json_str_chunks):
+    """
+    This function yields a feature collection as text chunks.
+
+    featurecollection -- the collection envelope with 'FEATURES'
+                         as placeholder for the features
+    json_str_chunks -- iterable of lists of feature json strings
+    """
+    head, tail = json.dumps(featurecollection).split('"FEATURES"', 1)
+    yield head + '['
+    separator = ''
+    for json_strs in json_str_chunks:
+        if len(json_strs) > 0:
+            yield separator + ', '.join(json_strs)
+            separator = ', '
+    yield ']' + tail
+
+def json_seq_chunks(json_str_chunks):
+    """
+    This function yields the given json texts as a GeoJSON
+    text sequence (RFC 8142), each text is preceded by a record
+    separator and followed by a newline.
+
+    json_str_chunks -- iterable of lists of json strings
+    """
+    for json_strs in json_str_chunks:
+        if len(json_strs) > 0:
+            yield ''.join(['\x1e%s\n' % json_str for json_str in json_strs])
+
+def json_type(value):
+    """
+    This function returns the name of the json type of a
+    parsed json value.
+    """
+    if value is None:
+        return 'null'
+    elif isinstance(value, bool):
+        return 'boolean'
+    elif isinstance(value, (int, long, float)):
+        return 'number'
+    elif isinstance(value, list):
+        return 'array'
+    elif isinstance(value, dict):
+        return 'object'
+    return 'string'
+
+def json_schema(obj, prefix = ''):
+    """
+    This function yields (key, type) pairs of the values in a
+    json object. The keys of nested objects are joined with
+    dots like the csv columns, lists are not entered.
+    """
+    for key, value in obj.items():
+        if prefix:
+            key = u'%s.%s' % (prefix, key)
+        if isinstance(value, dict):
+            for item in json_schema(value, key):
+                yield item
+        else:
+            yield (key, json_type(value))
+
+def zoom_resolution(zoom, srid):
+    """
+    This function returns the size of a pixel of a 256 pixel
+    web map tile at the zoom level in the units of the srid.
+
+    The EPSG codes 4000-4999 are treated as geographic
+    coordinate systems in degrees, others in meters.
+    """
+    if 4000 <= srid < 5000:
+        world_width = 360.0
+    else:
+        world_width = 2 * math.pi * 6378137
+    return world_width / (256 * 2 ** zoom)
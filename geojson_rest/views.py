@@ -1,8 +1,23 @@
+import base64
+import hashlib
 from django.conf import settings
+from django.core.cache import get_cache
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.db import transaction
+from django.db.models import Max
+from django.db.models import Q
 from django.core.exceptions import ObjectDoesNotExist
-from django.utils import simplejson as json
+from django.http import HttpResponse as DjangoHttpResponse
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+from django.contrib.gis.geos import GEOSException
+from django.contrib.gis.geos import GEOSGeometry
+from django.contrib.gis.geos import Polygon
 from geonition_utils.exceptions import Http400
 from geonition_utils.http import HttpResponse
 from geonition_utils.http import HttpResponseBadRequest
@@ -11,17 +26,265 @@ from geonition_utils.http import HttpResponseForbidden
 from geonition_utils.http import HttpResponseNotFound
 from geonition_utils.http import HttpResponseUnauthorized
 from geonition_utils.views import RequestHandler
+from geojson_rest import featurecache
+from geojson_rest import jsonbackend as json
+from geojson_rest import mvt
+from geojson_rest.geometry import from_geojson
+from geojson_rest.geometry import get_srid
+from geojson_rest.models import compose_properties
 from geojson_rest.models import Feature
+from geojson_rest.models import FeatureCounter
+from geojson_rest.models import GroupVersion
 from geojson_rest.models import Property
+from geojson_rest.models import PropertyValue
+from geojson_rest.models import SimplifiedGeometry
+from geojson_rest.utils import feature_collection_chunks
+from geojson_rest.utils import json_seq_chunks
 from geojson_rest.utils import send_error_mail
+from geojson_rest.utils import zoom_resolution
 
 def featurecount(request, data_group):
-    count = Feature.objects.filter(group=data_group).count()
+    """
+    This function returns the number of features in the group
+    from the maintained counters.
+
+    The count can be limited to the features of one user with
+    the user parameter and to the private or public features
+    with private=true or private=false.
+    """
+    private = request.GET.get('private', None)
+    if private is not None:
+        if private not in ('true', 'false'):
+            return HttpResponseBadRequest('private should be true or false')
+        private = private == 'true'
+    count = FeatureCounter.get_count(data_group,
+                                     username = request.GET.get('user', None),
+                                     private = private)
     return HttpResponse(str(count))
+
+def feature_tile(request, group, z, x, y):
+    """
+    This function returns the features of a group visible to
+    the signed in user as a Mapbox Vector Tile.
+
+    The tiles are cached with the version of the group and its
+    last expiry in the key, so writes to the group and expired
+    features invalidate its cached tiles.
+    """
+    if not request.user.is_authenticated():
+        return HttpResponseUnauthorized("The request has to be made by a"
+                                        "signed in user")
+    
+    z, x, y = int(z), int(x), int(y)
+    if z > 30 or x >= 2 ** z or y >= 2 ** z:
+        return HttpResponseNotFound("The tile does not exist")
+    
+    if request.user.is_staff:
+        visibility = 'staff'
+    else:
+        visibility = request.user.pk
+    version, modified = GroupVersion.get_version(group)
+    key = u'%s:%i:%s:%s:%s:%i/%i/%i' % (group,
+                                        version,
+                                        modified,
+                                        get_last_expiry(group),
+                                        visibility,
+                                     z,
+                                     x,
+                                     y)
+    key = 'geojson_rest:tile:%s' % hashlib.md5(key.encode('utf-8')).hexdigest()
+    
+    tile_cache = get_cache(getattr(settings, 'GEOJSON_REST_TILE_CACHE', 'default'))
+    tile = tile_cache.get(key)
+    if tile is None:
+        tile = render_tile(request, group, z, x, y)
+        tile_cache.set(key,
+                       tile,
+                       getattr(settings, 'GEOJSON_REST_TILE_CACHE_TIMEOUT', 3600))
+    
+    return DjangoHttpResponse(tile,
+                              content_type = 'application/vnd.mapbox-vector-tile')
+
+def render_tile(request, group, z, x, y):
+    """
+    This function encodes the visible features of the group
+    in the tile as a vector tile layer named by the group.
+    """
+    bounds = mvt.tile_bounds(z, x, y)
+    bbox = Polygon.from_bbox(bounds)
+    bbox.srid = 3857
+    
+    features = Feature.objects.all()
+    if group != '@all':
+        features = features.filter(group = group)
+    features = filter_user(request, features, '@all')
+    features = filter_time(features, '@now')
+    features = features.filter(geometry__bboverlaps = bbox)
+    features = list(features.transform(3857).select_related('user').order_by('id'))
+    property_json_strs = Feature.get_property_json_strs([feat.id for feat in features])
+    
+    tile_features = []
+    for feat in features:
+        tile_geometry = mvt.tile_geometry(feat.geometry, bounds)
+        if tile_geometry is None:
+            continue
+        
+        properties = json.loads(compose_properties(property_json_strs.get(feat.id, [])))
+        # the property ids are not attributes of the feature
+        properties.pop('id', None)
+        properties.update({'user': feat.user.username,
+                           'group': feat.group,
+                           'private': feat.private})
+        tile_features.append((feat.id,
+                              tile_geometry[0],
+                              tile_geometry[1],
+                              properties))
+    
+    return mvt.encode_layer(group, tile_features)
  
 
+def get_group_version(request, group):
+    """
+    This function returns the (version, modified) tuple of the
+    group, it is queried only once for each request.
+    """
+    if not hasattr(request, '_group_versions'):
+        request._group_versions = {}
+    if group not in request._group_versions:
+        request._group_versions[group] = GroupVersion.get_version(group)
+    return request._group_versions[group]
+
+def get_last_expiry(group):
+    """
+    This function returns the latest expire time of the
+    features of the group that has already passed, None if no
+    feature of the group has expired.
+
+    The features valid @now change when a feature expires
+    without a write to the group, so the expire time is a part
+    of the version of the @now representations. The expire
+    times are written to TimeD outside of this application, so
+    the expiry is queried with one aggregate that uses the
+    (group, time) index of the features and the expire_time
+    index of the times.
+    """
+    features = Feature.objects.all()
+    if group != '@all':
+        features = features.filter(group = group)
+    features = features.filter(time__expire_time__lte = timezone.now())
+    return features.aggregate(last_expiry = Max('time__expire_time'))['last_expiry']
+
+def get_group_expiry(request, group):
+    """
+    This function returns the last expiry of the group for a
+    request of the features valid @now and None for the other
+    time filters, it is queried only once for each request.
+    """
+    if request.GET.get('time', '@now') != '@now':
+        return None
+    if not hasattr(request, '_group_expiries'):
+        request._group_expiries = {}
+    if group not in request._group_expiries:
+        request._group_expiries[group] = get_last_expiry(group)
+    return request._group_expiries[group]
+
+def group_etag(request, *args, **kwargs):
+    """
+    This function returns the ETag of a feature or property
+    GET request. The representation depends on the group
+    version, the features expired by now, the signed in user
+    and the query parameters.
+    """
+    group = kwargs.get('group', '@self')
+    version, modified = get_group_version(request, group)
+    key = u'%s:%i:%s:%s:%s' % (group,
+                               version,
+                               get_group_expiry(request, group),
+                               request.user.pk,
+                               request.get_full_path())
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+def group_last_modified(request, *args, **kwargs):
+    """
+    This function returns the time of the latest write
+    to the group of a feature or property GET request, or of
+    the latest expiry if it is later.
+    """
+    group = kwargs.get('group', '@self')
+    version, modified = get_group_version(request, group)
+    last_expiry = get_group_expiry(request, group)
+    if last_expiry is not None and (modified is None or last_expiry > modified):
+        return last_expiry
+    return modified
+
+@condition(etag_func = group_etag,
+           last_modified_func = group_last_modified)
+def feature_clusters(request, user, group):
+    """
+    This function returns the features of a feature GET
+    request aggregated into the cells of a regular grid.
+
+    Each non empty cell is returned as a Point feature in the
+    mean centroid of its features, with the number of features
+    and the bounds of the cell as properties. The cell size is
+    given in the units of the srid with cell=<size> or as the
+    GEOJSON_REST_CLUSTER_PIXELS wide cells of a zoom=<z> level.
+    The grouping is done by the database so the size of the
+    response depends on the viewport and not on the data.
+    """
+    if not request.user.is_authenticated():
+        return HttpResponseUnauthorized("The request has to be made by a"
+                                        "signed in user")
+    
+    try:
+        features = filter_features(request, user, group)
+        srid = Feature._meta.get_field('geometry').srid
+        if 'srid' in request.GET:
+            srid = parse_srid(request.GET['srid'])
+        cell_size = parse_cell_size(request.GET, srid)
+    except ValueError as error:
+        return HttpResponseBadRequest(str(error))
+    
+    qn = connection.ops.quote_name
+    id_sql, id_params = features.values('id').query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT floor(ST_X(point) / %%s) AS cell_x, "
+        "floor(ST_Y(point) / %%s) AS cell_y, "
+        "count(*), avg(ST_X(point)), avg(ST_Y(point)) "
+        "FROM (SELECT ST_Centroid(ST_Transform(%s, %%s)) AS point "
+        "FROM %s WHERE %s IN (%s)) AS points "
+        "GROUP BY cell_x, cell_y "
+        "ORDER BY cell_y, cell_x" % (qn(Feature._meta.get_field('geometry').column),
+                                     qn(Feature._meta.db_table),
+                                     qn(Feature._meta.pk.column),
+                                     id_sql),
+        [cell_size, cell_size, srid] + list(id_params))
+    
+    clusters = []
+    for cell_x, cell_y, count, x, y in cursor.fetchall():
+        clusters.append({
+            'type': 'Feature',
+            'geometry': {'type': 'Point',
+                         'coordinates': [x, y]},
+            'properties': {'count': count,
+                           'cell': [cell_x * cell_size,
+                                    cell_y * cell_size,
+                                    (cell_x + 1) * cell_size,
+                                    (cell_y + 1) * cell_size]}
+        })
+    
+    return HttpResponse(json.dumps({
+        'type': 'FeatureCollection',
+        'features': clusters,
+        'crs': {"type": "name", "properties": {"code": "EPSG:%i" % srid}}
+    }))
+
+
 class FeatureView(RequestHandler):
 
+    @method_decorator(condition(etag_func = group_etag,
+                                last_modified_func = group_last_modified))
     def get(self,
             request,
             user = '@me',
@@ -48,61 +311,108 @@ class FeatureView(RequestHandler):
 #             features = Feature.objects.all()
             
 
-        #take initial all
-        features = Feature.objects.all()
-        
-        #filter the ones that has feature_id feature
-        if feature != None:
-            features = features.filter(id = feature)
-        
-        #filter the ones that belong to the group
-        if group != '@all':
-            features = features.filter(group = group)
-        
-        #filter the ones that belong to the user
-        if user != '@all' and user != '@others':
-            user_obj = get_user(request, username = user)
-        
-            if user != '@me':
-            
-                if request.user != user_obj:
-                    features = features.filter(user = user_obj,
-                                               private = False)
-                else:
-                    features = features.filter(user = user_obj)
-                
-            else:
-                features = features.filter(user = user_obj)  
-        
-        elif user == '@others':
-            features = features.filter(private = False)
-            features = features.exclude(user = request.user)
-            
-        else: # user is @all
-            if request.user and request.user.is_staff:
-                pass
+        #a geojson text sequence is always streamed
+        sequence = request.GET.get('format', None) == 'geojsonseq'
+        stream = sequence or request.GET.get('stream',
+                                             getattr(settings,
+                                                     'GEOJSON_REST_STREAM_COLLECTIONS',
+                                                     False)) in (True, 'true', '1')
+        cache_status = None
+        try:
+            if stream or not featurecache.is_enabled():
+                collection_chunks, next_url = self.get_collection(request,
+                                                                  user,
+                                                                  group,
+                                                                  feature)
             else:
-                own_features = features.filter(user = request.user)
-                others_features = features.filter(private = False)
-                others_features = others_features.exclude(user = request.user)
-                features = own_features | others_features
-                
-        
-        if len(features) > 0:
-            srid = features[0].geometry.srid
+                #the key changes with the version of the group, the host
+                #is a part of it as the next links are absolute urls
+                key = 'geojson_rest:collection:%s' % hashlib.md5(
+                        '%s:%s' % (group_etag(request, group = group),
+                                   request.build_absolute_uri('/'))).hexdigest()
+                (content, next_url), cache_status = featurecache.get_or_build(
+                        key,
+                        lambda: self.render_collection(request, user, group, feature))
+                collection_chunks = [content]
+        except ValueError as error:
+            return HttpResponseBadRequest(str(error))
+        
+        if sequence:
+            response = StreamingHttpResponse(collection_chunks,
+                                             content_type = 'application/geo+json-seq')
+        elif stream:
+            response = StreamingHttpResponse(collection_chunks,
+                                             content_type = 'application/json')
         else:
-            srid = getattr(settings, "SPATIAL_REFERENCE_SYSTEM_ID", 4326)
+            response = HttpResponse(''.join(collection_chunks))
+        if cache_status is not None:
+            response['X-GeoJSON-Cache'] = cache_status
+        if next_url is not None:
+            response['Link'] = '<%s>; rel="next"' % next_url
+        return response
+    
+    def get_collection(self, request, user, group, feature):
+        """
+        This function returns the text chunks of the feature
+        collection of a GET request and the url of the next
+        page, None if there is no next page.
+
+        With format=geojsonseq the features are returned as a
+        GeoJSON text sequence without the collection envelope.
+
+        raises ValueError if a query parameter is invalid
+        """
+        features = filter_features(request, user, group, feature)
+        
+        #page through the features in id order, the cursor is the
+        #last id of the previous page so no OFFSET is needed
+        features = features.order_by('id')
+        next_url = None
+        limit = get_page_size(request)
+        if 'cursor' in request.GET:
+            features = features.filter(id__gt = decode_cursor(request.GET['cursor']))
+        
+        page = list(features.values_list('id', flat = True)[:limit + 1])
+        if len(page) > limit:
+            page = page[:limit]
+            next_url = get_next_url(request, page[-1], limit)
+        features = Feature.objects.filter(id__in = page)
+        
+        #all geometries are stored in the srid of the geometry column
+        #and transformed by the database if another srid is requested
+        srid = Feature._meta.get_field('geometry').srid
+        tolerance = None
+        if 'srid' in request.GET:
+            srid = parse_srid(request.GET['srid'])
+        if 'simplify' in request.GET or 'zoom' in request.GET:
+            tolerance = parse_tolerance(request.GET)
+        
+        if request.GET.get('format', None) == 'geojsonseq':
+            return (json_seq_chunks(Feature.json_str_chunks(features, srid, tolerance)),
+                    next_url)
             
         featurecollection = {
             'type': 'FeatureCollection',
             'features': 'FEATURES',
             'crs': {"type": "name", "properties": {"code": "EPSG:%i" % srid}}
         }
-        collection_str = json.dumps(featurecollection)
-        collection_str = collection_str.replace(
-                '\"FEATURES\"',
-                '[' + ', '.join([feat.get_json_str() for feat in features]) + ']')
-        return HttpResponse(collection_str)
+        if next_url is not None:
+            featurecollection['next'] = next_url
+        collection_chunks = feature_collection_chunks(
+                featurecollection,
+                Feature.json_str_chunks(features, srid, tolerance))
+        return (collection_chunks, next_url)
+    
+    def render_collection(self, request, user, group, feature):
+        """
+        This function returns the feature collection of a GET
+        request as one string with the url of the next page.
+        """
+        collection_chunks, next_url = self.get_collection(request,
+                                                          user,
+                                                          group,
+                                                          feature)
+        return (''.join(collection_chunks), next_url)
         
     def post(self,
             request,
@@ -128,9 +438,16 @@ class FeatureView(RequestHandler):
         
         json_obj_response = {}
         
+        if json_object.get('type') == 'FeatureCollection':
+            return self.post_collection(request, json_object, user, group)
+        
         new_feature = Feature(user = user,
                               group = group)
-        new_feature.create(json_object)
+        try:
+            new_feature.create(json_object)
+        except (KeyError, TypeError, ValueError):
+            send_error_mail(request, 'This sould be a feature but is not: %s\n\n' % request.body)
+            return HttpResponseBadRequest('invalid feature')
         uri = "%s/%s/%s/%i" % (reverse('feat'),
                                user.username,
                                group,
@@ -138,6 +455,37 @@ class FeatureView(RequestHandler):
         created_entity = new_feature.get_json_str()
         
         return HttpResponseCreated(uri, created_entity)
+    
+    def post_collection(self, request, featurecollection, user, group):
+        """
+        This function creates all the features of a posted
+        feature collection in one transaction and returns them
+        as a feature collection with the uri of each feature.
+        """
+        try:
+            new_features = Feature.create_collection(featurecollection['features'],
+                                                     user,
+                                                     group,
+                                                     featurecollection.get('crs', None))
+        except (KeyError, TypeError, ValueError):
+            send_error_mail(request, 'This sould be a feature collection but is not: %s\n\n' % request.body)
+            return HttpResponseBadRequest('invalid feature collection')
+        
+        uri = "%s/%s/%s" % (reverse('feat'),
+                            user.username,
+                            group)
+        created_collection = {
+            'type': 'FeatureCollection',
+            'features': 'FEATURES',
+            'uris': ["%s/%i" % (uri, new_feature.id)
+                     for new_feature in new_features]
+        }
+        json_strs = Feature.get_json_strs([new_feature.id for new_feature in new_features])
+        created_entity = ''.join(feature_collection_chunks(
+                created_collection,
+                [[json_strs[new_feature.id] for new_feature in new_features]]))
+        
+        return HttpResponseCreated(uri, created_entity)
 
     def put(self,
             request,
@@ -185,6 +533,8 @@ class FeatureView(RequestHandler):
     
 class PropertyView(RequestHandler):
     
+    @method_decorator(condition(etag_func = group_etag,
+                                last_modified_func = group_last_modified))
     def get(self,
             request,
             user = '@me',
@@ -244,14 +594,17 @@ class PropertyView(RequestHandler):
         json_obj_response = {}
         new_property = Property(user = user,
                                 group = group)
-        new_property.create(json_object)
+        # the property is visible with the feature only after the
+        # add, so the group version is bumped again after it
+        with transaction.commit_on_success():
+            new_property.create(json_object)
+            if feature != '@null':
+                feat = Feature.objects.get(id = feature, group = group)
+                feat.properties.add(new_property)
+                Feature.invalidate([feat.id])
         
         uri = ""
         if feature != '@null': #connect feature to property
-            feat = Feature.objects.get(id = feature, group = group)
-            feat.properties.add(new_property)
-            #update features JSON cache
-            feat.update_json_str()
             uri = "%s/%s/%s/%s/%i" % (reverse('prop'),
                                       user.username,
                                       group,
@@ -290,9 +643,9 @@ class PropertyView(RequestHandler):
                 property = Property.objects.get(id = property,
                                             user = user)
                 property.update(json_object)
-                if property.feature_set.count() > 0: #update features connected to property
-                    for feat in property.feature_set.all():
-                        feat.update_json_str()
+                #update features connected to property
+                Feature.invalidate(
+                    list(property.feature_set.values_list('id', flat = True)))
             else:
                 return HttpResponseForbidden('You cannot update others properties')
         
@@ -311,11 +664,10 @@ class PropertyView(RequestHandler):
             return HttpResponseForbidden('You need to sign in to delete properties')
         else:
             property = Property.objects.get(id = property)
-            if property.feature_set.count() > 0: #delete property from connected features 
-                for feat in property.feature_set.all():
-                    feat.properties.remove(property)
-                    feat.update_json_str()
+            #the property is removed from the connected features with the property
+            feature_ids = list(property.feature_set.values_list('id', flat = True))
             property.delete()
+            Feature.invalidate(feature_ids)
         
         return HttpResponse("A property was deleted")
 
@@ -333,3 +685,280 @@ def get_user(request, username = '@me'):
         user = User.objects.get(username = username)
     
     return user
+
+def get_page_size(request):
+    """
+    This function returns the number of features that should
+    be returned for the request.
+
+    The limit parameter is capped to the server side maximum
+    GEOJSON_REST_MAX_PAGE_SIZE. Requests without a limit get
+    the default page size GEOJSON_REST_PAGE_SIZE, which is the
+    maximum if it is not set.
+    """
+    max_page_size = getattr(settings, 'GEOJSON_REST_MAX_PAGE_SIZE', 1000)
+    limit = request.GET.get('limit',
+                            getattr(settings, 'GEOJSON_REST_PAGE_SIZE', max_page_size))
+    
+    try:
+        limit = int(limit)
+    except (ValueError, TypeError):
+        raise ValueError('limit should be a positive integer')
+    if limit < 1:
+        raise ValueError('limit should be a positive integer')
+    
+    return min(limit, max_page_size)
+
+def encode_cursor(last_id):
+    """
+    This function returns an opaque cursor pointing after
+    the feature with the given id.
+    """
+    return base64.urlsafe_b64encode('id:%i' % last_id)
+
+def decode_cursor(cursor):
+    """
+    This function returns the last feature id of the previous
+    page from a cursor made with encode_cursor.
+    """
+    try:
+        key, last_id = base64.urlsafe_b64decode(str(cursor)).split(':')
+        if key != 'id':
+            raise ValueError
+        return int(last_id)
+    except (TypeError, ValueError, UnicodeEncodeError):
+        raise ValueError('invalid cursor')
+
+def get_next_url(request, last_id, limit):
+    """
+    This function returns the absolute url of the page
+    following the feature with last_id.
+    """
+    params = request.GET.copy()
+    params['cursor'] = encode_cursor(last_id)
+    params['limit'] = limit
+    return request.build_absolute_uri('%s?%s' % (request.path,
+                                                 params.urlencode()))
+
+def filter_features(request, user, group, feature = None):
+    """
+    This function returns the features queried by a feature
+    GET request, filtered by the id, group, time, properties,
+    area and user of the request.
+
+    raises ValueError if a query parameter is invalid
+    """
+    #take initial all
+    features = Feature.objects.all()
+    
+    #filter the ones that has feature_id feature
+    if feature != None:
+        features = features.filter(id = feature)
+    
+    #filter the ones that belong to the group
+    if group != '@all':
+        features = features.filter(group = group)
+    
+    #filter the ones that are inside the requested area
+    #and valid at the requested time
+    features = filter_time(features,
+                           request.GET.get('time', '@now'))
+    features = filter_properties(features, request.GET)
+    if 'bbox' in request.GET:
+        features = features.filter(
+            geometry__bboverlaps = parse_bbox(request.GET['bbox']))
+    if 'intersects' in request.GET:
+        features = features.filter(
+            geometry__intersects = parse_geometry(request.GET['intersects']))
+    
+    #filter the ones that belong to the user
+    return filter_user(request, features, user)
+
+def filter_user(request, features, user):
+    """
+    This function returns the features of the user that
+    the signed in user is allowed to see.
+
+    user -- username, '@me', '@others' for the public features
+            of other users or '@all' for all visible features
+    """
+    if user != '@all' and user != '@others':
+        user_obj = get_user(request, username = user)
+    
+        if user != '@me':
+        
+            if request.user != user_obj:
+                features = features.filter(user = user_obj,
+                                           private = False)
+            else:
+                features = features.filter(user = user_obj)
+            
+        else:
+            features = features.filter(user = user_obj)  
+    
+    elif user == '@others':
+        features = features.filter(private = False)
+        features = features.exclude(user = request.user)
+        
+    else: # user is @all
+        if request.user and request.user.is_staff:
+            pass
+        else:
+            own_features = features.filter(user = request.user)
+            others_features = features.filter(private = False)
+            others_features = others_features.exclude(user = request.user)
+            features = own_features | others_features
+    
+    return features
+
+def filter_time(features, time):
+    """
+    This function returns the features that are valid
+    at the given time.
+
+    time -- '@now' for the features that have not expired,
+            '@all' for all features or an ISO 8601 timestamp
+            for the features valid at that instant
+    """
+    if time == '@all':
+        return features
+    elif time == '@now':
+        return features.filter(Q(time__expire_time__isnull = True) |
+                               Q(time__expire_time__gt = timezone.now()))
+    
+    instant = parse_datetime(time)
+    if instant is None:
+        raise ValueError('time should be @now, @all or an ISO 8601 timestamp')
+    if settings.USE_TZ and timezone.is_naive(instant):
+        instant = timezone.make_aware(instant,
+                                      timezone.get_default_timezone())
+    
+    features = features.filter(time__create_time__lte = instant)
+    return features.filter(Q(time__expire_time__isnull = True) |
+                           Q(time__expire_time__gt = instant))
+
+def filter_properties(features, params):
+    """
+    This function returns the features that have property
+    values matching the prop.<key>[__<lookup>] parameters.
+
+    The lookup can be in (comma separated values), gt, gte,
+    lt or lte, without a lookup the values should be equal.
+    """
+    for param, value in params.items():
+        if not param.startswith('prop.'):
+            continue
+        
+        key = param[len('prop.'):]
+        lookup = 'exact'
+        if '__' in key:
+            key, lookup = key.rsplit('__', 1)
+        values = PropertyValue.match(key, lookup, value)
+        feature_properties = Feature.properties.through.objects.filter(
+            property__in = values.values('property'))
+        features = features.filter(id__in = feature_properties.values('feature'))
+    
+    return features
+
+def parse_srid(srid):
+    """
+    This function returns the srid parameter as an integer
+    if the spatial reference system is known to the database.
+    """
+    try:
+        srid = int(srid)
+    except ValueError:
+        raise ValueError('srid should be an integer')
+    if srid != Feature._meta.get_field('geometry').srid:
+        spatial_ref_sys = connection.ops.spatial_ref_sys()
+        if not spatial_ref_sys.objects.filter(srid = srid).exists():
+            raise ValueError('unknown srid %i' % srid)
+    
+    return srid
+
+def parse_tolerance(params):
+    """
+    This function returns the precomputed simplification
+    tolerance for the simplify=<tolerance> or zoom=<z>
+    parameter, None if the full geometries should be used.
+    """
+    try:
+        if 'simplify' in params:
+            tolerance = float(params['simplify'])
+        else:
+            tolerance = zoom_resolution(int(params['zoom']),
+                                        Feature._meta.get_field('geometry').srid)
+    except (ValueError, OverflowError):
+        raise ValueError('simplify should be a number and zoom an integer')
+    
+    return SimplifiedGeometry.get_tolerance(tolerance)
+
+def parse_cell_size(params, srid):
+    """
+    This function returns the width of the grid cells for
+    the cell=<size> or zoom=<z> parameter in the units of
+    the srid.
+    """
+    if 'cell' not in params and 'zoom' not in params:
+        raise ValueError('cell or zoom should be given')
+    try:
+        if 'cell' in params:
+            cell_size = float(params['cell'])
+        else:
+            cell_size = zoom_resolution(int(params['zoom']), srid) * \
+                        getattr(settings, 'GEOJSON_REST_CLUSTER_PIXELS', 64)
+    except (ValueError, OverflowError):
+        raise ValueError('cell should be a number and zoom an integer')
+    
+    if not cell_size > 0:
+        raise ValueError('cell should be a positive number')
+    return cell_size
+
+def parse_bbox(bbox):
+    """
+    This function parses a bbox parameter of the form
+    minx,miny,maxx,maxy[,srid] into a polygon that can be
+    used in the spatial lookups of the feature queries.
+
+    If srid is not given the srid of the geometry column
+    is assumed, a given srid has to be known to the database.
+    """
+    values = bbox.split(',')
+    if len(values) not in (4, 5):
+        raise ValueError('bbox should be given as minx,miny,maxx,maxy[,srid]')
+    try:
+        polygon = Polygon.from_bbox([float(value) for value in values[:4]])
+    except (ValueError, TypeError):
+        raise ValueError('bbox should contain only numbers')
+    if len(values) == 5:
+        polygon.srid = parse_srid(values[4])
+    else:
+        polygon.srid = Feature._meta.get_field('geometry').srid
+    
+    return polygon
+
+def parse_geometry(geometry):
+    """
+    This function parses a geometry parameter given either
+    as a geojson geometry (or feature) or as WKT / EWKT.
+
+    The coordinate reference system of a geojson geometry
+    is read from its crs member, otherwise the srid of the
+    geometry column is assumed.
+    """
+    srid = Feature._meta.get_field('geometry').srid
+    try:
+        if geometry.strip().startswith('{'):
+            geojson = json.loads(geometry)
+            srid = get_srid(geojson) or srid
+            if geojson.get('type') == 'Feature':
+                geojson = geojson['geometry']
+            geos_geometry = from_geojson(geojson, srid)
+        else:
+            geos_geometry = GEOSGeometry(geometry)
+            if geos_geometry.srid is None:
+                geos_geometry.srid = srid
+    except (ValueError, TypeError, KeyError, IndexError, AttributeError, GEOSException):
+        raise ValueError('the geometry should be given as geojson or WKT')
+    
+    return geos_geometry